@@ -0,0 +1,657 @@
+"""
+Kitt Peak solar atlas store
+
+The atlas ships as ~250 whitespace separated text files ``resource/lm*`` with
+columns (wavelength [nm], normalized intensity, raw intensity).  Parsing them
+with ``np.loadtxt`` dominates the start up time of the validators, so this
+module converts them once into a single wavelength sorted ``.npy`` file that
+is opened with ``np.load(mmap_mode="r")`` on every later run.
+
+Code that only needs a few wavelength regions can call
+``AtlasStore.slice(lo, hi)``: with a current cache the rows are read from the
+memmap (only the pages of the range are touched), and on a cold cache only
+the ~4 nm text chunks overlapping the range are parsed (and kept for the next
+call) instead of building the whole cache.
+
+For overview plots the store also keeps a min/max/mean pyramid of the
+normalized intensity at several decimation levels (``pyramid.npz``), and
+``AtlasStore.envelope`` picks the level that matches the pixel width of the
+figure instead of drawing a million points.
+
+A cold build (fresh checkout or changed ``lm*`` files) parses the text files
+in a process pool, each worker writing its rows straight into one
+preallocated ``.npy`` memmap, and reports per file timing and throughput.
+
+``AtlasStore.line_catalog`` derives a catalog of absorption lines (local
+minima with their depth and FWHM) from the atlas once, and answers "which
+lines overlap this wavelength range" with a binary search.
+
+The store keeps a small JSON manifest of the source files (name, size, mtime
+and sha256).  The binary cache is rebuilt only when a source file is added,
+removed, or its size or content hash changes.
+
+Usage:
+    from kitt_peak_atlas import AtlasStore
+    atlas = AtlasStore().load()        # (n_rows, 3) read-only memmap
+    band = AtlasStore().slice(1073.5, 1076.0)
+"""
+
+import os
+import json
+import glob
+import time
+import hashlib
+import logging
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Union
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+
+RESOURCE_DIR = Path(__file__).resolve().parent.parent / "resource"
+CACHE_DIR_NAME = "atlas_cache"
+ATLAS_GLOB = "lm*"
+STORE_VERSION = 2
+# Rows per bin of each pyramid level, level 0 is the atlas itself
+PYRAMID_FACTORS = (16, 64, 256, 1024, 4096)
+# Line catalog: minimum depth below the local continuum, and the half width
+# in atlas samples of the window the continuum is taken from (~0.1 nm at 1 um)
+LINE_MIN_DEPTH = 0.02
+LINE_WINDOW = 75
+
+
+def _chunk_range(path: Path, probe: int = 256) -> Tuple[float, float]:
+    """Wavelength range of one atlas text file from its first and last rows
+
+    The atlas files are sorted by wavelength, so only the head and tail of
+    each file need to be read.
+    """
+    with open(path, "rb") as f:
+        head = f.read(probe).split(b"\n")
+        f.seek(max(0, path.stat().st_size - probe))
+        tail = f.read().split(b"\n")
+    first = next(line for line in head if line.strip())
+    last = next(line for line in reversed(tail) if line.strip())
+    return float(first.split()[0]), float(last.split()[0])
+
+
+def _bin_rows(atlas: np.ndarray, factor: int) -> Dict[str, np.ndarray]:
+    """Reduce consecutive blocks of ``factor`` atlas rows to one bin
+
+    Returns:
+        Dict of per bin arrays: start (first wavelength), wave (mean
+        wavelength), and min, max and mean of the normalized intensity
+    """
+    starts = np.arange(0, atlas.shape[0], factor)
+    counts = np.diff(np.append(starts, atlas.shape[0]))
+    wave = np.asarray(atlas[:, 0])
+    intensity = np.asarray(atlas[:, 1])
+    return {"start": wave[starts],
+            "wave": np.add.reduceat(wave, starts) / counts,
+            "min": np.minimum.reduceat(intensity, starts),
+            "max": np.maximum.reduceat(intensity, starts),
+            "mean": np.add.reduceat(intensity, starts) / counts}
+
+
+class LineCatalog:
+    """Absorption lines of the atlas with an interval index
+
+    Each line spans [lo, hi], its half depth crossings.  Lines are sorted by
+    ``lo``; since no line is wider than ``max_width`` the lines overlapping a
+    range are found with two binary searches.
+    """
+
+    FIELDS = ("wave", "depth", "fwhm", "lo", "hi")
+
+    def __init__(self, wave: np.ndarray, depth: np.ndarray, lo: np.ndarray,
+                 hi: np.ndarray):
+        order = np.argsort(lo, kind="stable")
+        self.wave = np.asarray(wave)[order]
+        self.depth = np.asarray(depth)[order]
+        self.lo = np.asarray(lo)[order]
+        self.hi = np.asarray(hi)[order]
+        self.fwhm = self.hi - self.lo
+        self.max_width = float(self.fwhm.max()) if len(self.fwhm) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.wave)
+
+    @classmethod
+    def from_atlas(cls, atlas: np.ndarray, min_depth: float = LINE_MIN_DEPTH,
+                   window: int = LINE_WINDOW) -> "LineCatalog":
+        """Find the absorption lines of a wavelength sorted atlas
+
+        A line is a local minimum of the normalized intensity at least
+        ``min_depth`` below the local continuum, the maximum intensity within
+        ``window`` samples.  Its width is measured between the linearly
+        interpolated crossings of the half depth level.
+
+        Args:
+            atlas: (n_rows, >=2) array of wavelength and normalized intensity
+            min_depth: Minimum line depth, in normalized intensity
+            window: Half width of the continuum window, in samples
+
+        Returns:
+            The line catalog
+        """
+        atlas = np.asarray(atlas)
+        # Some chunks are duplicated in resource/, keep one row per wavelength
+        _, first = np.unique(atlas[:, 0], return_index=True)
+        wave = atlas[first, 0]
+        intensity = atlas[first, 1]
+        n = len(wave)
+
+        padded = np.pad(intensity, window, mode="edge")
+        continuum = np.lib.stride_tricks.sliding_window_view(padded, 2 * window + 1).max(axis=1)
+        depth = continuum - intensity
+        minimum = np.zeros(n, dtype=bool)
+        minimum[1:-1] = (intensity[1:-1] < intensity[:-2]) & (intensity[1:-1] <= intensity[2:])
+        lines = np.nonzero(minimum & (depth >= min_depth))[0]
+
+        half = intensity[lines] + depth[lines] / 2
+        edges = []
+        for direction in (-1, 1):
+            # Walk outward from every line at once until the half level is crossed
+            j = lines.copy()
+            active = np.ones(len(lines), dtype=bool)
+            for _ in range(window):
+                step = np.clip(j + direction, 0, n - 1)
+                active &= (step != j) & (intensity[j] < half)
+                j = np.where(active, step, j)
+                if not active.any():
+                    break
+            inner = np.clip(j - direction, 0, n - 1)
+            rise = intensity[j] - intensity[inner]
+            frac = np.where(rise != 0, (half - intensity[inner]) / np.where(rise != 0, rise, 1), 1)
+            edges.append(wave[inner] + np.clip(frac, 0, 1) * (wave[j] - wave[inner]))
+        return cls(wave[lines], depth[lines], edges[0], edges[1])
+
+    def overlapping(self, lo: float, hi: float, min_depth: float = 0.0) -> np.ndarray:
+        """Indices of the lines whose extent overlaps [lo, hi]"""
+        start = np.searchsorted(self.lo, lo - self.max_width, side="left")
+        stop = np.searchsorted(self.lo, hi, side="right")
+        hits = np.arange(start, stop)
+        return hits[(self.hi[hits] >= lo) & (self.depth[hits] >= min_depth)]
+
+    def near(self, wavelength: float, half_width: float, min_depth: float = 0.0) -> np.ndarray:
+        """Indices of the lines overlapping wavelength +/- half_width"""
+        return self.overlapping(wavelength - half_width, wavelength + half_width, min_depth)
+
+    def save(self, path: Path, **metadata) -> None:
+        tmp_path = Path(path).with_suffix(".tmp.npz")
+        np.savez(tmp_path, wave=self.wave, depth=self.depth, lo=self.lo, hi=self.hi, **metadata)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "LineCatalog":
+        with np.load(path) as data:
+            return cls(data["wave"], data["depth"], data["lo"], data["hi"])
+
+
+def _bisect(rows: np.ndarray, value: float, side: str = "left") -> int:
+    """np.searchsorted(rows[:, 0], value, side) without copying the column
+
+    The wavelength column of the atlas memmap is strided, and searchsorted
+    would read all of it into a contiguous copy first.
+    """
+    lo, hi = 0, rows.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if rows[mid, 0] < value or (side == "right" and rows[mid, 0] == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _sha256(path: Path, block_size: int = 1 << 20) -> str:
+    """Content hash of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _count_rows(path: Path) -> int:
+    """Number of rows ``np.loadtxt`` will return for an atlas text file"""
+    with open(path, "rb") as f:
+        return sum(1 for line in f if line.strip() and not line.lstrip().startswith(b"#"))
+
+
+def _parse_into(path: Path, out_path: Path, offset: int, rows: int) -> Tuple[str, float, str]:
+    """Parse one atlas text file into rows [offset, offset+rows) of a .npy memmap
+
+    Runs in the build worker processes.
+
+    Returns:
+        (file name, parse seconds, sha256 of the file)
+    """
+    start = time.perf_counter()
+    chunk = np.loadtxt(path, ndmin=2)
+    if chunk.shape[0] != rows:
+        raise ValueError(f"{path}: expected {rows} rows, parsed {chunk.shape[0]}")
+    out = np.load(out_path, mmap_mode="r+")
+    out[offset:offset + rows] = chunk
+    out.flush()
+    del out
+    return path.name, time.perf_counter() - start, _sha256(path)
+
+
+def _pool_context():
+    """Process start method for build workers
+
+    Only ``fork`` is used: the validators are plain scripts without a
+    ``__main__`` guard, so spawned workers would re-run them.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+
+@dataclass
+class BuildReport:
+    """Timing of an atlas cache build"""
+    workers: int = 1
+    files: List[Tuple[str, int, int, float]] = field(default_factory=list)  # name, rows, bytes, seconds
+    total_seconds: float = 0.0
+
+    @property
+    def rows(self) -> int:
+        return sum(f[1] for f in self.files)
+
+    @property
+    def bytes(self) -> int:
+        return sum(f[2] for f in self.files)
+
+    def __str__(self) -> str:
+        seconds = max(self.total_seconds, 1e-9)
+        return (f"Parsed {len(self.files)} atlas files ({self.bytes / 1e6:.1f} MB, {self.rows} rows) "
+                f"with {self.workers} worker(s) in {self.total_seconds:.2f} s: "
+                f"{self.bytes / 1e6 / seconds:.1f} MB/s, {self.rows / seconds:.0f} rows/s")
+
+
+class AtlasStore:
+    """Binary cache of the Kitt Peak atlas text files"""
+
+    def __init__(self, resource_dir: Union[Path, str] = RESOURCE_DIR,
+                 cache_dir: Optional[Union[Path, str]] = None):
+        """Initialize the atlas store
+
+        Args:
+            resource_dir: Directory holding the ``lm*`` atlas text files
+            cache_dir: Directory for the binary cache, defaults to
+                       ``resource_dir/atlas_cache``
+        """
+        self.resource_dir = Path(resource_dir)
+        self.cache_dir = Path(cache_dir) if cache_dir else self.resource_dir / CACHE_DIR_NAME
+        self.array_path = self.cache_dir / "atlas.npy"
+        self.manifest_path = self.cache_dir / "atlas.json"
+        self.pyramid_path = self.cache_dir / "pyramid.npz"
+        self.lines_path = self.cache_dir / "lines.npz"
+        self._atlas: Optional[np.ndarray] = None
+        self._current: Optional[bool] = None
+        self._index: Optional[Dict[str, Tuple[float, float]]] = None
+        self._chunks: Dict[str, np.ndarray] = {}
+        self._pyramid: Optional[Dict[int, Dict[str, np.ndarray]]] = None
+        self.last_build: Optional[BuildReport] = None
+
+    @property
+    def sources(self) -> List[Path]:
+        """Atlas text files, in a stable (name sorted) order"""
+        return sorted(Path(p) for p in glob.glob(str(self.resource_dir / ATLAS_GLOB))
+                      if Path(p).is_file())
+
+    @property
+    def index(self) -> Dict[str, Tuple[float, float]]:
+        """Map of atlas file name to its (min, max) wavelength in nm"""
+        if self._index is None:
+            self._index = {path.name: _chunk_range(path) for path in self.sources}
+        return self._index
+
+    def chunks_for(self, lo: float, hi: float) -> List[Path]:
+        """Atlas text files whose wavelength range overlaps [lo, hi]"""
+        return [self.resource_dir / name for name, (c_lo, c_hi) in self.index.items()
+                if c_lo <= hi and c_hi >= lo]
+
+    def _read_chunk(self, path: Path) -> np.ndarray:
+        if path.name not in self._chunks:
+            logging.debug(f"Parsing atlas file {path}")
+            self._chunks[path.name] = np.loadtxt(path, ndmin=2)
+        return self._chunks[path.name]
+
+    def slice(self, lo: float, hi: float) -> np.ndarray:
+        """Atlas rows covering the wavelength range [lo, hi]
+
+        The nearest row on either side of the range is included, so a nearest
+        neighbour lookup anywhere inside [lo, hi] gives the same row as a
+        lookup in the full atlas.  When the binary cache is current the rows
+        come from its memmap, otherwise only the text chunks overlapping the
+        range are parsed and cached; the cache itself is never built here.
+
+        Args:
+            lo: Lower wavelength bound [nm]
+            hi: Upper wavelength bound [nm]
+
+        Returns:
+            (n_rows, 3) array sorted by wavelength
+        """
+        if self._atlas is None and self._cache_current():
+            self._atlas = np.load(self.array_path, mmap_mode="r")
+        if self._atlas is not None:
+            rows = self._atlas
+        else:
+            paths = self.chunks_for(lo, hi)
+            # Neighbouring chunks supply the bracketing rows at the edges.
+            names = list(self.index)
+            extra = set()
+            for path in paths:
+                i = names.index(path.name)
+                extra.update(names[max(i - 1, 0):i + 2])
+            paths = [self.resource_dir / name for name in names if name in extra]
+            if not paths:
+                return np.zeros([0, 3])
+            rows = np.concatenate([self._read_chunk(path) for path in paths], axis=0)
+            rows = rows[np.argsort(rows[:, 0], kind="stable")]
+        start = max(_bisect(rows, lo, side="left") - 1, 0)
+        stop = min(_bisect(rows, hi, side="right") + 1, rows.shape[0])
+        return rows[start:stop]
+
+    def _cache_current(self) -> bool:
+        """is_current, checked once per store"""
+        if self._current is None:
+            self._current = self.is_current()
+        return self._current
+
+    def _read_manifest(self) -> Optional[Dict]:
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self, manifest: Dict) -> None:
+        tmp_path = self.manifest_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def is_current(self) -> bool:
+        """Check the binary cache against the atlas text files
+
+        Sizes are compared first; a file whose mtime changed is re-hashed and
+        only counts as changed when its content hash differs.
+
+        Returns:
+            True if the cache exists and matches every source file
+        """
+        manifest = self._read_manifest()
+        if manifest is None or manifest.get("version") != STORE_VERSION:
+            return False
+        if not self.array_path.exists():
+            return False
+        recorded = {entry["name"]: entry for entry in manifest["sources"]}
+        sources = self.sources
+        if sorted(recorded) != [p.name for p in sources]:
+            return False
+
+        touched = False
+        for path in sources:
+            entry = recorded[path.name]
+            stat = path.stat()
+            if stat.st_size != entry["size"]:
+                return False
+            if stat.st_mtime_ns != entry["mtime_ns"]:
+                if _sha256(path) != entry["sha256"]:
+                    return False
+                entry["mtime_ns"] = stat.st_mtime_ns
+                touched = True
+        if touched:
+            # Fresh checkouts change every mtime, remember the new ones so the
+            # next run can skip hashing again.
+            self._write_manifest(manifest)
+        return True
+
+    def build(self, workers: Optional[int] = None) -> np.ndarray:
+        """Parse every atlas text file and write the sorted binary cache
+
+        Rows are counted first so the output can be preallocated as a .npy
+        memmap; the files are then parsed in a process pool with every worker
+        writing its own rows in place.  The result is identical, byte for
+        byte, to concatenating the files in name order and stable sorting by
+        wavelength, whatever the number of workers.
+
+        Args:
+            workers: Number of parse processes, defaults to the CPU count
+                     (1 on platforms without ``fork``)
+
+        Returns:
+            The (n_rows, 3) atlas array, sorted by wavelength
+        """
+        sources = self.sources
+        if not sources:
+            raise FileNotFoundError(f"No Kitt Peak atlas files found in {self.resource_dir}")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        context = _pool_context()
+        if workers is None:
+            workers = (os.cpu_count() or 1) if context is not None else 1
+        workers = max(1, min(workers, len(sources)))
+
+        start = time.perf_counter()
+        rows = [_count_rows(path) for path in sources]
+        offsets = np.concatenate(([0], np.cumsum(rows)[:-1]))
+        raw_path = self.cache_dir / "atlas.raw.npy"
+        raw = np.lib.format.open_memmap(raw_path, mode="w+", dtype=np.float64,
+                                        shape=(int(sum(rows)), 3))
+        del raw
+
+        jobs = list(zip(sources, [raw_path] * len(sources), offsets.tolist(), rows))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                results = list(pool.map(_parse_into, *zip(*jobs),
+                                        chunksize=max(1, len(jobs) // (workers * 4))))
+        else:
+            results = [_parse_into(*job) for job in jobs]
+
+        raw = np.load(raw_path, mmap_mode="r")
+        atlas = raw[np.argsort(raw[:, 0], kind="stable")]
+        del raw
+        os.remove(raw_path)
+        tmp_path = self.array_path.with_suffix(".tmp.npy")
+        np.save(tmp_path, atlas)
+        os.replace(tmp_path, self.array_path)
+        self._write_pyramid(atlas)
+        if self.lines_path.exists():
+            os.remove(self.lines_path)
+
+        report = BuildReport(workers=workers)
+        entries = []
+        for path, n_rows, (name, seconds, digest) in zip(sources, rows, results):
+            stat = path.stat()
+            report.files.append((name, n_rows, stat.st_size, seconds))
+            entries.append({"name": name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                            "sha256": digest, "rows": n_rows})
+            logging.debug(f"{name}: {n_rows} rows in {seconds * 1000:.1f} ms")
+        self._write_manifest({"version": STORE_VERSION, "sources": entries})
+        self._current = True
+        report.total_seconds = time.perf_counter() - start
+        self.last_build = report
+        logging.info(str(report))
+        return atlas
+
+    def load(self, mmap_mode: Optional[str] = "r") -> np.ndarray:
+        """Open the binary atlas, rebuilding it first if it is stale
+
+        Args:
+            mmap_mode: Passed to ``np.load``; None reads the array into memory
+
+        Returns:
+            The (n_rows, 3) atlas array, sorted by wavelength
+        """
+        if not self.is_current():
+            logging.info(f"Building Kitt Peak atlas cache in {self.cache_dir}")
+            self.build()
+        self._atlas = np.load(self.array_path, mmap_mode=mmap_mode)
+        return self._atlas
+
+    def _write_pyramid(self, atlas: np.ndarray) -> None:
+        levels = {}
+        for factor in PYRAMID_FACTORS:
+            for name, values in _bin_rows(atlas, factor).items():
+                levels[f"{factor}_{name}"] = values
+        tmp_path = self.pyramid_path.with_suffix(".tmp.npz")
+        np.savez(tmp_path, **levels)
+        os.replace(tmp_path, self.pyramid_path)
+        self._pyramid = None
+
+    def pyramid(self) -> Dict[int, Dict[str, np.ndarray]]:
+        """Decimated min/max/mean levels of the atlas, keyed by rows per bin
+
+        Builds the atlas cache first if it is stale.
+        """
+        if self._pyramid is None:
+            if self._atlas is None or not self.pyramid_path.exists():
+                self.load()
+            self._pyramid = {}
+            with np.load(self.pyramid_path) as data:
+                for factor in PYRAMID_FACTORS:
+                    self._pyramid[factor] = {name: data[f"{factor}_{name}"]
+                                             for name in ("start", "wave", "min", "max", "mean")}
+        return self._pyramid
+
+    def envelope(self, lo: float, hi: float, n_pixels: int,
+                 use_pyramid: Optional[bool] = None) -> Dict[str, np.ndarray]:
+        """Atlas intensity envelope over [lo, hi] at about one bin per pixel
+
+        Picks the coarsest pyramid level that still has at least ``n_pixels``
+        bins in the range; narrow ranges fall through to the raw rows.
+
+        Args:
+            lo: Lower wavelength bound [nm]
+            hi: Upper wavelength bound [nm]
+            n_pixels: Width of the plotted range in pixels
+            use_pyramid: Read the persisted pyramid (building the atlas cache
+                         if needed).  By default it is used only once the full
+                         atlas is open; otherwise the bins are reduced from
+                         ``slice(lo, hi)`` on the fly.
+
+        Returns:
+            Dict of arrays wave, min, max and mean, plus ``factor``, the
+            number of atlas rows per bin
+        """
+        if use_pyramid is None:
+            use_pyramid = self._atlas is not None
+        if use_pyramid:
+            self.pyramid()
+        rows = self.slice(lo, hi)
+        factor = 1
+        for candidate in PYRAMID_FACTORS:
+            if rows.shape[0] // candidate >= n_pixels:
+                factor = candidate
+        if factor == 1:
+            return {"wave": rows[:, 0], "min": rows[:, 1], "max": rows[:, 1],
+                    "mean": rows[:, 1], "factor": 1}
+        if use_pyramid:
+            level = self.pyramid()[factor]
+            start = max(np.searchsorted(level["start"], lo, side="right") - 1, 0)
+            stop = np.searchsorted(level["start"], hi, side="right")
+            bins = {name: values[start:stop] for name, values in level.items()
+                    if name != "start"}
+        else:
+            bins = _bin_rows(rows, factor)
+            del bins["start"]
+        bins["factor"] = factor
+        return bins
+
+    def manifest_hash(self) -> Optional[str]:
+        """Hash of the atlas sources recorded in the manifest
+
+        Changes whenever the cache is rebuilt from different files; mtimes are
+        left out so a fresh checkout of the same atlas keeps its hash.
+
+        Returns:
+            Hex digest, or None without a manifest
+        """
+        manifest = self._read_manifest()
+        if manifest is None:
+            return None
+        digest = hashlib.sha256(str(manifest.get("version")).encode())
+        for entry in sorted(manifest["sources"], key=lambda entry: entry["name"]):
+            digest.update(f"{entry['name']} {entry['size']} {entry['sha256']}\n".encode())
+        return digest.hexdigest()
+
+    def line_catalog(self, min_depth: float = LINE_MIN_DEPTH) -> LineCatalog:
+        """Absorption line catalog of the atlas, built once and cached
+
+        A persisted catalog is returned without opening the atlas when the
+        cache is current and the catalog was built from the same manifest and
+        ``min_depth``; otherwise it is rebuilt from the full atlas.
+        """
+        if self.lines_path.exists() and self._cache_current():
+            with np.load(self.lines_path) as data:
+                cached = (float(data["min_depth"]),
+                          str(data["manifest_hash"]) if "manifest_hash" in data else None)
+            if cached == (min_depth, self.manifest_hash()):
+                return LineCatalog.load(self.lines_path)
+        if self._atlas is None:
+            self.load()
+        logging.info(f"Building absorption line catalog in {self.lines_path}")
+        catalog = LineCatalog.from_atlas(self._atlas, min_depth=min_depth)
+        catalog.save(self.lines_path, min_depth=min_depth, manifest_hash=self.manifest_hash())
+        return catalog
+
+    def plot_envelope(self, ax, lo: Optional[float] = None, hi: Optional[float] = None,
+                      color: str = "0.6", label: Optional[str] = "Kitt Peak atlas",
+                      **kwargs):
+        """Draw the atlas on a matplotlib axis at the resolution of the axis
+
+        Args:
+            ax: Axis to draw on; its x limits are used when lo/hi are not given
+            lo: Lower wavelength bound [nm]
+            hi: Upper wavelength bound [nm]
+            color: Fill and line colour
+            label: Legend label of the mean line
+            **kwargs: Passed to ``envelope``
+
+        Returns:
+            The envelope dict that was drawn
+        """
+        x_lo, x_hi = ax.get_xlim()
+        lo = x_lo if lo is None else lo
+        hi = x_hi if hi is None else hi
+        n_pixels = max(int(ax.get_window_extent().width), 1)
+        bins = self.envelope(lo, hi, n_pixels, **kwargs)
+        if bins["factor"] > 1:
+            ax.fill_between(bins["wave"], bins["min"], bins["max"], color=color,
+                            alpha=0.4, linewidth=0)
+        ax.plot(bins["wave"], bins["mean"], color=color, linewidth=0.5, label=label)
+        return bins
+
+
+def get_kitt_peak_atlas(resource_dir: Union[Path, str] = RESOURCE_DIR) -> np.ndarray:
+    """Load the Kitt Peak atlas through the binary cache"""
+    return AtlasStore(resource_dir).load()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the Kitt Peak atlas binary cache")
+    parser.add_argument("--resource-dir", type=Path, default=RESOURCE_DIR,
+                        help="Directory holding the lm* atlas files")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild even if the cache is current")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="Parse processes for the build (default: CPU count)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Report per file parse times")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(levelname)s: %(message)s')
+
+    store = AtlasStore(args.resource_dir)
+    if args.force or not store.is_current():
+        atlas = store.build(workers=args.workers)
+        print(f"Wrote {atlas.shape[0]} rows to {store.array_path}")
+    else:
+        print(f"{store.array_path} is current")
@@ -17,7 +17,23 @@ def gaussian(x, amplitude=1.0, center=1074.7, sigma=1.0, expon=2.0):
     return (amplitude/(np.sqrt(2*np.pi)*sigma))* np.exp(-abs(x-center)**expon / (2*sigma**expon))
 
 
-def createStages(cont="both",cam="onband",wavelength=None,width=1, filterConfig={},stages=5,lcvrTemp=[],offsets=[],step=None):
+def tuningPhases(cam="onband",cont="both",stages=5):
+    '''Fixed phase offsets of each stage for a camera/continuum selection, see createStages.'''
+    phase = np.zeros(stages)
+    try:  #deal with times stages = 1 
+        if cam != "onband":
+            phase[1] = np.pi/2
+        if cont =="red":
+            phase[0] = -np.pi/8
+        if cont =="blue":
+            phase[0] = +np.pi/8
+    except:
+        pass
+    return phase
+
+
+def createStages(cont="both",cam="onband",wavelength=None,width=1, filterConfig={},stages=5,lcvrTemp=[],offsets=[],step=None,
+                 dtype=np.float64,chunk_size=None):
     '''Create a simulation of a multi stage lyot/bi-refigent filter similar to what is used in UCoMP
     
     Parameters:
@@ -55,6 +71,10 @@ def createStages(cont="both",cam="onband",wavelength=None,width=1, filterConfig=
     tempMeasurements (list):  List of acutal tempature measruements at time of data.  Phase correction for each 
                                stage is applied as: applied as phase - tempCoff*(tempMeasurement - refTemp)
 
+    dtype (np.float64 or np.float32): Precision of the returned profile.  x is always float64.
+    chunk_size (int): Low memory mode, evaluate at most this many samples at a time, in place in the output array.
+                      With dtype or chunk_size set the profile is computed by stageProductLowMemory, see there for
+                      the error of float32 against float64.
     
     '''
     FSR = 1
@@ -71,28 +91,723 @@ def createStages(cont="both",cam="onband",wavelength=None,width=1, filterConfig=
         refCoff = filterConfig["tempCof"]
     if wavelength == None:
         wavelength = region
-    phase = np.zeros(stages)
-    try:  #deal with times stages = 1 
-        if cam != "onband":
-            phase[1] = np.pi/2
-        if cont =="red":
-            phase[0] = -np.pi/8
-        if cont =="blue":
-            phase[0] = +np.pi/8
-    except:
-        pass
+    phase = tuningPhases(cam=cam,cont=cont,stages=stages)
     if step == None:
         step = FSR/5000
     x = np.arange(region-FSR/2*width,region+FSR/2*width,step)
-    result = np.ones(x.shape[0])
     if len(offsets) != stages:
         offsets = [0] * stages
         if len(lcvrTemp) == stages:
-            offsets = (lcvrTemp-refTemp)*tempCoff
+            offsets = temperature_offsets(filterConfig,lcvrTemp)[0]
+    if chunk_size is None and np.dtype(dtype) == np.float64:
+        result = stageProduct(x-wavelength,FSR,phase-np.asarray(offsets,dtype=np.float64),stages)
+    else:
+        result = stageProductLowMemory(x,wavelength,FSR,phase-np.asarray(offsets,dtype=np.float64),stages,dtype=dtype,
+                                       chunk_size=chunk_size)
+    return x, result
+
+
+def stageProduct(delta,FSR,phase,stages=5):
+    '''Product over stages of cos^2(2^s*pi*delta/FSR + phase[s]), the Lyot profile at delta = x - wavelength.
+
+    phase has shape (stages,), or (rows, stages) for a 2d delta of shape (rows, samples).
+
+    When no stage above 1 carries a phase (no temperature offsets: cam and cont only shift stages 0 and 1) the
+    product of the phase-free stages telescopes,
+        prod_{s=k}^{N-1} cos(2^s*t) = sin(2^N*t) / (2^(N-k)*sin(2^k*t)),
+    so those stages cost two sines instead of one cosine each.  Doubling an angle is exact in floating point and both
+    sines are taken of the same angle, so this agrees with the stage loop to rounding error.  Any other phase pattern
+    uses the stage loop.
+    '''
+    phase = np.asarray(phase,dtype=np.float64)
+    if phase.ndim == 2:
+        phase = phase[:,:,None]   # (rows, stages, 1) broadcasts against (rows, samples)
+    stagePhase = (lambda s: phase[s]) if phase.ndim == 1 else (lambda s: phase[:,s])
+    if stages >= 3 and not np.any(stagePhase(slice(2,None))):
+        first = 2 if np.any(phase) else 0
+        theta = np.pi*delta/FSR
+        numerator = np.sin(2**stages*theta)
+        denominator = 2**(stages-first)*np.sin(2**first*theta)
+        # At the exact peaks every stage is +/-1, the limit of the ratio squared is 1.
+        ratio = np.divide(numerator,denominator,out=np.ones_like(numerator),where=denominator != 0)
+        result = ratio**2
+        for s in range(first):
+            result = result*np.cos(2**s*theta + stagePhase(s))**2
+        return result
+    result = np.ones(np.shape(delta))
     for s in range(stages):
-        result = result*np.cos(2**s*np.pi*(x-wavelength)/FSR + phase[s]-offsets[s])**2
+        result = result*np.cos(2**s*np.pi*delta/FSR + stagePhase(s))**2
+    return result
+
+
+def stageProductLowMemory(x,wavelength,FSR,phase,stages=5,dtype=np.float32,chunk_size=65536):
+    '''stageProduct for a long 1d grid x without full size temporaries: the profile is built in place in the output
+    array, chunk_size samples at a time, so peak memory is the output plus a few chunk sized scratch arrays: 4 bytes
+    per sample for float32 against several float64 temporaries of the whole grid for the default createStages.
+
+    The angle pi*(x - wavelength)/FSR is formed and reduced modulo pi in float64 (every stage is periodic in it with
+    period pi) before it is rounded to dtype, so the float32 error does not grow with width or with the distance
+    from the tuning.  Measured against float64 over 13 FSRs for every tuning_calibration region, cam and cont the
+    float32 profile is within 2.2e-6 absolute (peak transmission 1) and its sum within 1e-7 relative.
+    '''
+    x = np.asarray(x)
+    phase = np.asarray(phase,dtype=np.float64)
+    result = np.empty(x.shape[0],dtype=dtype)
+    if chunk_size is None:
+        chunk_size = x.shape[0]
+    chunk_size = max(int(chunk_size),1)
+    angles = np.empty(min(chunk_size,x.shape[0]),dtype=dtype)
+    scratch = np.empty_like(angles)
+    for start in range(0,x.shape[0],chunk_size):
+        out = result[start:start+chunk_size]
+        theta = angles[:out.shape[0]]
+        work = scratch[:out.shape[0]]
+        theta[:] = np.mod(np.pi*(x[start:start+chunk_size]-wavelength)/FSR,np.pi)
+        out[:] = 1
+        for s in range(stages):
+            np.multiply(theta,2**s,out=work)
+            work += phase[s]
+            np.cos(work,out=work)
+            work *= work
+            out *= work
+    return result
+
+
+def createStagesBatch(cont="both",cam="onband",wavelength=None,width=1,filterConfig={},stages=5,offsets=[],step=None,
+                      chunk_size=None,dtype=np.float64):
+    '''Batched createStages: profiles for many tunings at once on the shared createStages wavelength grid.
+
+    wavelength (array): Tuning wavelengths, one profile per entry (None gives a single profile at the region).
+    cam, cont: A single value for every tuning, or one value per tuning (see createStages for the options).
+    offsets: Per stage phase offsets, shape (stages,) for all tunings or (n_tunings, stages).
+    chunk_size (int): Evaluate at most this many tunings at a time, bounding the temporary arrays to
+                      chunk_size x n_samples.  None evaluates all tunings in one pass.
+    dtype: Storage of the returned profiles, np.float32 halves the output (each chunk is still evaluated in float64).
+
+    Returns x (n_samples,) and the profiles (n_tunings, n_samples), row i identical to
+    createStages(wavelength=wavelength[i], cam=cam[i], cont=cont[i], ...)[1].
+    '''
+    FSR = filterConfig.get("FSR",1)
+    region = filterConfig.get("region",0)
+    if wavelength is None:
+        wavelength = region
+    wavelength = np.atleast_1d(np.asarray(wavelength,dtype=np.float64))
+    n = wavelength.shape[0]
+    cams = [cam]*n if isinstance(cam,str) else list(cam)
+    conts = [cont]*n if isinstance(cont,str) else list(cont)
+    phase = np.array([tuningPhases(cam=c,cont=o,stages=stages) for c,o in zip(cams,conts)]).reshape(n,stages)
+    if len(offsets) == 0:
+        offsets = np.zeros(stages)
+    offsets = np.broadcast_to(np.asarray(offsets,dtype=np.float64),(n,stages))
+    if step == None:
+        step = FSR/5000
+    x = np.arange(region-FSR/2*width,region+FSR/2*width,step)
+    result = np.empty((n,x.shape[0]),dtype=dtype)
+    if chunk_size is None:
+        chunk_size = n
+    for start in range(0,n,max(int(chunk_size),1)):
+        rows = slice(start,start+chunk_size)
+        delta = x[None,:]-wavelength[rows,None]
+        result[rows] = stageProduct(delta,FSR,phase[rows]-offsets[rows],stages)
     return x, result
 
+
+class LyotTemplate:
+    '''One high resolution period of the Lyot profile for a region, cam, cont and set of phase offsets.
+
+    Retuning only translates the profile, and the profile repeats every FSR, so the profile for any tuning
+    wavelength on the createStages grid is read out of this template instead of evaluating the stage cosines again.
+    When the tuning is a whole number of template samples away from the grid (e.g. wavelength = region, or any
+    shift by a multiple of step) the result is an exact periodic index shift of the template.  Other tunings are
+    linearly interpolated between template samples; error_bound is a guaranteed bound on the absolute difference
+    from createStages in that case.
+
+    oversample (int): Template samples per createStages step.  The interpolation error falls as 1/oversample**2,
+                      with the default 8 it is about 1e-6 of the peak transmission.
+    template (array): A template computed before (e.g. by another process, see shared_store.py) to use instead of
+                      evaluating it again.
+    '''
+
+    def __init__(self,filterConfig={},cam="onband",cont="both",offsets=[],stages=5,step=None,oversample=8,
+                 template=None):
+        self.FSR = filterConfig.get("FSR",1)
+        self.region = filterConfig.get("region",0)
+        self.stages = stages
+        self.step = self.FSR/5000 if step == None else step
+        self.oversample = max(int(oversample),1)
+        psi = tuningPhases(cam=cam,cont=cont,stages=stages)
+        if len(offsets) == stages:
+            psi = psi-np.asarray(offsets,dtype=np.float64)
+        # Template samples per FSR, an integer multiple of oversample when step divides the FSR.
+        perFSR = self.FSR/self.step
+        self.aligned = abs(perFSR-round(perFSR)) < 1e-9*perFSR
+        self.size = int(round(perFSR))*self.oversample if self.aligned else int(np.ceil(perFSR*self.oversample))
+        self.spacing = self.FSR/self.size
+        if template is None:
+            template = stageProduct(self.spacing*np.arange(self.size),self.FSR,psi,stages)
+        elif len(template) != self.size:
+            raise ValueError(f"Template has {len(template)} samples, expected {self.size}")
+        self.template = template
+        k = 2.0**np.arange(stages)*np.pi/self.FSR
+        # |P''| <= sum(k^2) + sum(k)^2 for a product of cos^2(k_s*x + phase_s) terms; linear interpolation is then
+        # within spacing^2/8*|P''|, plus snapping a shift within snap_tolerance samples onto the template.
+        self.snap_tolerance = 1e-6
+        self.error_bound = self.spacing**2/8*(np.sum(k**2)+np.sum(k)**2) + self.snap_tolerance*self.spacing*np.sum(k)
+
+    def grid(self,width=1):
+        '''The createStages wavelength grid for this region.'''
+        return np.arange(self.region-self.FSR/2*width,self.region+self.FSR/2*width,self.step)
+
+    def profiles(self,wavelength,width=1,chunk_size=None):
+        '''Profiles for an array of tuning wavelengths, same return as createStagesBatch: x (n_samples,) and the
+        profiles (n_tunings, n_samples).'''
+        wavelength = np.atleast_1d(np.asarray(wavelength,dtype=np.float64))
+        x = self.grid(width)
+        result = np.empty((wavelength.shape[0],x.shape[0]))
+        if chunk_size is None:
+            chunk_size = max(wavelength.shape[0],1)
+        for start in range(0,wavelength.shape[0],max(int(chunk_size),1)):
+            rows = slice(start,start+chunk_size)
+            if self.aligned:
+                # Sample i of the grid sits oversample template samples after sample i-1, so each row is one
+                # fractional start position followed by a fixed stride through the template.
+                position = np.mod(x[0]-wavelength[rows],self.FSR)/self.spacing
+                first = np.floor(position)
+                fraction = position-first
+                snap = (fraction < self.snap_tolerance) | (fraction > 1-self.snap_tolerance)
+                first = np.where(snap,np.round(position),first).astype(np.int64)
+                fraction = np.where(snap,0.0,fraction)[:,None]
+                index = first[:,None]+self.oversample*np.arange(x.shape[0])[None,:]
+            else:
+                position = np.mod(x[None,:]-wavelength[rows,None],self.FSR)/self.spacing
+                index = np.floor(position).astype(np.int64)
+                fraction = position-index
+            index %= self.size
+            low = self.template[index]
+            if not np.any(fraction):
+                result[rows] = low
+            else:
+                result[rows] = low+fraction*(self.template[(index+1) % self.size]-low)
+        return x, result
+
+    def profile(self,wavelength=None,width=1):
+        '''Single tuning, same return as createStages.'''
+        x, result = self.profiles(self.region if wavelength is None else wavelength,width=width)
+        return x, result[0]
+
+
+_profileTemplates = {}
+
+def getProfileTemplate(filterConfig={},cam="onband",cont="both",offsets=[],stages=5,step=None,oversample=8,
+                       template=None):
+    '''LyotTemplate for (region, cam, cont, offsets), built on first use and reused for every later tuning.
+    template seeds the cache with a precomputed LyotTemplate.template array.'''
+    key = (filterConfig.get("FSR",1),filterConfig.get("region",0),cam,cont,tuple(np.asarray(offsets,dtype=float)),
+           stages,step,oversample)
+    if key not in _profileTemplates:
+        _profileTemplates[key] = LyotTemplate(filterConfig,cam=cam,cont=cont,offsets=offsets,stages=stages,step=step,
+                                              oversample=oversample,template=template)
+    return _profileTemplates[key]
+
+
+def createStagesTemplated(cont="both",cam="onband",wavelength=None,width=1,filterConfig={},stages=5,offsets=[],
+                          step=None,chunk_size=None,oversample=8):
+    '''createStagesBatch read out of cached LyotTemplates: one template per (cam, cont) in the batch, every tuning
+    after that is an index shift (plus linear interpolation, see LyotTemplate.error_bound) rather than new cosines.
+    '''
+    if wavelength is None:
+        wavelength = filterConfig.get("region",0)
+    wavelength = np.atleast_1d(np.asarray(wavelength,dtype=np.float64))
+    n = wavelength.shape[0]
+    cams = [cam]*n if isinstance(cam,str) else list(cam)
+    conts = [cont]*n if isinstance(cont,str) else list(cont)
+    groups = {}
+    for i,selection in enumerate(zip(cams,conts)):
+        groups.setdefault(selection,[]).append(i)
+    x = None
+    result = None
+    for (c,o),rows in groups.items():
+        template = getProfileTemplate(filterConfig,cam=c,cont=o,offsets=offsets,stages=stages,step=step,
+                                      oversample=oversample)
+        x, profiles = template.profiles(wavelength[rows],width=width,chunk_size=chunk_size)
+        if result is None:
+            result = np.empty((n,x.shape[0]))
+        result[rows] = profiles
+    return x, result
+
+def periodic_grid(filterConfig={},width=1,step=None):
+    '''Wavelength grid of createStages built so that it spans exactly width FSRs (width should be an integer).
+    On this grid a change of tuning wavelength by a whole number of steps is a circular shift of the profile.
+    '''
+    FSR = filterConfig.get("FSR",1)
+    region = filterConfig.get("region",0)
+    if step == None:
+        step = FSR/5000
+    n = int(round(width*FSR/step))
+    return region-FSR/2*width + step*np.arange(n)
+
+
+def tuning_sweep(filterConfig={},prefilter=None,atlas=None,cams=("onband","offband"),conts=("both","red","blue"),
+                 width=1,step=None,stages=5,method="nearest",wavelengths=None):
+    '''Throughput versus tuning wavelength for a whole region in one FFT correlation per profile.
+
+    Retuning the Lyot filter translates its profile, so the prefilter (and atlas) weighted throughput for every tuning
+    on the createStages grid is the circular cross-correlation of the weight with the profile tuned to 0.  This gives
+    the same numbers as calling createStages and summing the weighted profile for each tuning, the loop in test.ipynb.
+
+    filterConfig (dict): Region config from getFilterConfig.  filterConfig["prefilter"] is used when prefilter is None.
+    prefilter (2d array): Prefilter table, wavelength [nm] and transmission [%] columns.
+    atlas (2d array): Optional Kitt Peak atlas (wavelength, normalized intensity) to also weight by, sorted.
+    cams, conts: Camera and continuum selections to compute, every combination is returned.
+    width (int): Number of FSRs in the grid (and range of tunings).
+    method (enum "nearest","linear"): How the prefilter and atlas are sampled on the grid, see lookup_sorted.
+    wavelengths (array): Tuning wavelengths to return, interpolated from the grid.  Defaults to the grid itself.
+
+    Returns (tunings, {(cam,cont): throughput}) where throughput is sum(weight*profile)/sum(profile), in the units of
+    the prefilter (so /100 gives the fraction printed in the tuning plot legends).
+    '''
+    FSR = filterConfig.get("FSR",1)
+    if step == None:
+        step = FSR/5000
+    x = periodic_grid(filterConfig,width=width,step=step)
+    if prefilter is None:
+        prefilter = filterConfig.get("prefilter")
+    weight = np.ones(x.shape[0])
+    if prefilter is not None:
+        weight = weight*lookup_sorted(prefilter[:,0],prefilter[:,1],x,method=method)
+    if atlas is not None:
+        weight = weight*lookup_sorted(atlas[:,0],atlas[:,1],x,method=method)
+
+    # Profile tuned to offset 0, indexed by sample offset (periodic over the grid).
+    offsets = step*np.arange(x.shape[0])
+    weight_fft = np.fft.rfft(weight)
+    results = {}
+    for cam in cams:
+        for cont in conts:
+            phase = tuningPhases(cam=cam,cont=cont,stages=stages)
+            profile = np.ones(x.shape[0])
+            for s in range(stages):
+                profile = profile*np.cos(2**s*np.pi*offsets/FSR + phase[s])**2
+            # corr[k] = sum_i weight[i]*profile[i-k], the throughput tuned to x[k]
+            corr = np.fft.irfft(weight_fft*np.conj(np.fft.rfft(profile)),n=x.shape[0])
+            throughput = corr/np.sum(profile)
+            if wavelengths is not None:
+                throughput = np.interp(wavelengths,x,throughput)
+            results[(cam,cont)] = throughput
+    tunings = x if wavelengths is None else np.asarray(wavelengths)
+    return tunings,results
+
+
+
+def adaptive_grid(func,lo,hi,rtol=1e-4,panels=64,min_width=0,max_depth=20,breaks=None,scale=None):
+    '''Non-uniform nodes and quadrature weights for integrating func over [lo, hi] by adaptive Simpson refinement.
+
+    The interval starts as panels equal panels; any panel whose Simpson estimate changes by more than its share of
+    rtol*|integral| when halved is split again, so samples pile up where func has structure (the Lyot passband and
+    its sidelobes) and stay sparse where it is flat (the deep wings).  Panels narrower than 2*min_width are not split.
+    Accepted panels use Boole's rule (the Richardson extrapolation of the two Simpson estimates), i.e. integrate the
+    quartic through their five nodes.
+
+    func (callable): Vectorized smooth function of wavelength.
+    scale (callable): Optional piecewise constant factor (such as a nearest neighbour prefilter lookup) that only
+                      changes at breaks.  It is evaluated once between each pair of breaks and folded into the weights
+                      by integrating each panel's quartic piecewise, so it adds no evaluations of func.
+
+    Returns (x, weights) with sum(weights*func(x)) the integral of func (times scale), within about rtol relative
+    error.
+    '''
+    a = np.linspace(lo,hi,panels+1)
+    a,b = a[:-1],a[1:]
+    m = (a+b)/2
+    fa,fm,fb = func(a),func(m),func(b)
+    total = None
+    starts,widths,values = [],[],[]
+    for depth in range(max_depth+1):
+        left,right = (a+m)/2,(m+b)/2
+        fl,fr = func(left),func(right)
+        h = b-a
+        coarse = h/6*(fa+4*fm+fb)
+        fine = h/12*(fa+4*fl+2*fm+4*fr+fb)
+        if total is None:
+            total = abs(np.sum(fine))
+        done = (np.abs(fine-coarse)/15 <= rtol*total*h/(hi-lo)) | (h <= 2*min_width) | (depth == max_depth)
+        starts.append(a[done])
+        widths.append(h[done])
+        values.append(np.stack([fa,fl,fm,fr,fb],axis=1)[done])
+        split = ~done
+        if not np.any(split):
+            break
+        # Children [a,m] and [m,b] reuse the three evaluations they already have
+        a,m,b = np.concatenate([a[split],m[split]]),np.concatenate([left[split],right[split]]),np.concatenate([m[split],b[split]])
+        fa,fm,fb = np.concatenate([fa[split],fm[split]]),np.concatenate([fl[split],fr[split]]),np.concatenate([fm[split],fb[split]])
+    a = np.concatenate(starts)
+    h = np.concatenate(widths)
+    order = np.argsort(a)
+    a,h = a[order],h[order]
+    nodes = a[:,None]+h[:,None]*np.linspace(0,1,5)[None,:]
+    weights = h[:,None]/90*np.array([7,32,12,32,7])[None,:]
+    if scale is not None:
+        breaks = np.unique(np.asarray([] if breaks is None else breaks,dtype=np.float64))
+        breaks = breaks[(breaks > lo) & (breaks < hi)]
+        edges = np.concatenate([[lo],breaks,[hi]])
+        level = scale((edges[:-1]+edges[1:])/2)
+        # Scale at the start of each panel, then a step of (new - old) level times the integral of the quartic from
+        # each break inside a panel to the end of that panel.
+        weights = weights*level[np.searchsorted(breaks,a,side="right")][:,None]
+        panel = np.searchsorted(a,breaks,side="right")-1
+        inside = breaks < a[panel]+h[panel]
+        panel,breaks = panel[inside],breaks[inside]
+        jump = np.diff(level)[inside]
+        # Antiderivatives of the Lagrange basis on the nodes 0,1/4,...,1, coefficients in increasing power
+        basis = np.linalg.inv(np.vander(np.linspace(0,1,5),5,increasing=True))
+        antiderivative = basis/np.arange(1,6)[:,None]
+        u = (breaks-a[panel])/h[panel]
+        tail = (np.sum(antiderivative,axis=0)[None,:]-(u[:,None]**np.arange(1,6)[None,:]) @ antiderivative)*h[panel,None]
+        np.add.at(weights,panel,jump[:,None]*tail)
+    x,inverse = np.unique(nodes.ravel(),return_inverse=True)
+    return x,np.bincount(inverse,weights=weights.ravel())
+
+
+def tuning_throughput(filterConfig={},wavelength=None,cam="onband",cont="both",prefilter=None,atlas=None,width=1,
+                      stages=5,offsets=[],method="nearest",sampling="adaptive",rtol=1e-4):
+    '''Prefilter (and atlas) weighted throughput of one tuning, sum(weight*profile)/sum(profile) as in tuning_sweep.
+
+    The profile repeats every FSR with a mean of exactly 2**-stages whatever the phases, so over the width FSRs of
+    the createStages grid the uniform sum of a profile is width*5000/2**stages and the legend numbers in the tuning
+    plots (weighted sum over the onband normalization sum, /100) are this throughput/100.
+
+    sampling (enum "adaptive","uniform"): "uniform" sums over the createStages grid.  "adaptive" integrates the
+              profile on an adaptive_grid instead: about 300-400 profile samples per FSR instead of 5000 for a five
+              stage filter.  Each grid sample is treated as the step wide cell around it, with the prefilter/atlas
+              weight held at its grid value, so the jumps of a nearest neighbour lookup land where they do in the
+              grid sum.  With the default rtol=1e-4 the result is within 1e-5 (relative) of the uniform sum for all
+              the tuning_calibration regions, +-0.8 nm around the region, for every cam and cont.
+
+    Returns (throughput, n_samples) where n_samples is the number of profile evaluations in the final grid.
+    '''
+    FSR = filterConfig.get("FSR",1)
+    region = filterConfig.get("region",0)
+    if wavelength is None:
+        wavelength = region
+    if prefilter is None:
+        prefilter = filterConfig.get("prefilter")
+    psi = tuningPhases(cam=cam,cont=cont,stages=stages)
+    if len(offsets) == stages:
+        psi = psi-np.asarray(offsets,dtype=np.float64)
+
+    def weight(x):
+        result = np.ones(np.shape(x))
+        if prefilter is not None:
+            result = result*lookup_sorted(prefilter[:,0],prefilter[:,1],x,method=method)
+        if atlas is not None:
+            result = result*lookup_sorted(atlas[:,0],atlas[:,1],x,method=method)
+        return result
+
+    def profile(x):
+        return stageProduct(x-wavelength,FSR,psi,stages)
+
+    step = FSR/5000
+    x = np.arange(region-FSR/2*width,region+FSR/2*width,step)
+    if sampling == "uniform":
+        return np.sum(weight(x)*profile(x))/np.sum(profile(x)),x.shape[0]
+    if sampling != "adaptive":
+        raise ValueError(f"Unknown sampling: {sampling}")
+    # The grid sum is the integral over the step wide cells around the samples, with the weight held at its value on
+    # the sample.  The weight lookups are cheap next to the profile, so they are done for the whole grid and only
+    # change the quadrature weights.
+    lo,hi = x[0]-step/2,x[0]+(x.shape[0]-0.5)*step
+    cells = weight(x)
+    breaks = x[1:][np.diff(cells) != 0]-step/2
+
+    def cellWeight(nodes):
+        return cells[np.clip(np.round((nodes-x[0])/step).astype(np.int64),0,x.shape[0]-1)]
+
+    # 64 starting panels per FSR keep the highest (32nd) harmonic of the profile resolved by each panel's quartic
+    nodes,weights = adaptive_grid(profile,lo,hi,rtol=rtol,panels=int(np.ceil(64*width)),min_width=step/8,
+                                  breaks=breaks,scale=cellWeight)
+    # The profile has a mean of exactly 2**-stages over each FSR (5000 grid samples), which leaves only the samples
+    # past the last whole FSR to sum.
+    periods = int(np.floor(x.shape[0]/5000))*5000
+    norm = periods/2**stages + np.sum(profile(x[periods:]))
+    return np.sum(weights*profile(nodes))/step/norm,nodes.shape[0]+x.shape[0]-periods
+
+
+def temperature_offsets(filterConfig={},lcvrTemps=[]):
+    '''Stage phase offsets tempCof*(T - tempRef) for LCVR temperatures, as applied by createStages (phase - offset).
+
+    lcvrTemps (array): Temperatures [C] in createStages stage order (largest period first, as tempRef/tempCof from
+                       getFilterConfig), shape (stages,) or (n_temps, stages) for a whole log.
+    Returns the offsets [rad], shape (n_temps, stages).
+    '''
+    lcvrTemps = np.atleast_2d(np.asarray(lcvrTemps,dtype=np.float64))
+    tempRef = np.asarray(filterConfig.get("tempRef",0),dtype=np.float64)
+    tempCof = np.asarray(filterConfig.get("tempCof",0),dtype=np.float64)
+    return (lcvrTemps-tempRef)*tempCof
+
+
+def temperature_ensemble(filterConfig={},lcvrTemps=[],wavelength=None,cam="onband",cont="both",prefilter=None,
+                         width=1,stages=5,step=None,chunk_size=None,dtype=np.float64):
+    '''Lyot profiles for a whole set of LCVR temperature vectors in one batch, with the drift of the tuned passband.
+
+    lcvrTemps (array): Shape (n_temps, stages), see temperature_offsets.  A logged day of temperatures is one call.
+    prefilter (2d array): Prefilter table to weight the throughput with, defaults to filterConfig["prefilter"] if
+                          present (otherwise the throughput is the unweighted passband area).
+
+    The passband is the main lobe (+-FSR/2**stages) around the highest peak of the profile at the reference
+    temperatures (tempRef, no offsets): the tuning for onband, the selected continuum peak for offband.
+
+    Returns (x, profiles, peak_shift, throughput_loss):
+        profiles (n_temps, n_samples): createStages profiles with the temperature offsets applied.
+        peak_shift (n_temps,): Move of the passband peak [nm] (parabolic interpolation between grid samples).
+        throughput_loss (n_temps,): 1 - (weighted passband sum)/(the same at the reference temperatures).
+    '''
+    offsets = temperature_offsets(filterConfig,lcvrTemps)
+    n = offsets.shape[0]
+    if wavelength is None:
+        wavelength = filterConfig.get("region",0)
+    FSR = filterConfig.get("FSR",1)
+    if step == None:
+        step = FSR/5000
+    # Row 0 is the reference profile
+    x, profiles = createStagesBatch(cont=cont,cam=cam,wavelength=np.full(n+1,wavelength),width=width,
+                                    filterConfig=filterConfig,stages=stages,offsets=np.vstack([np.zeros(stages),offsets]),
+                                    step=step,chunk_size=chunk_size,dtype=dtype)
+    center = int(np.argmax(profiles[0]))
+    half = int(round(FSR/2**stages/step))
+    window = slice(max(center-half,0),min(center+half+1,x.shape[0]))
+    passband = profiles[:,window]
+
+    peak = np.argmax(passband,axis=1)
+    inner = np.clip(peak,1,passband.shape[1]-2)
+    rows = np.arange(n+1)
+    below,at,above = passband[rows,inner-1],passband[rows,inner],passband[rows,inner+1]
+    curvature = below-2*at+above
+    vertex = np.divide(below-above,2*curvature,out=np.zeros(n+1),where=curvature != 0)
+    position = x[window][inner]+np.clip(vertex,-1,1)*step
+
+    if prefilter is None:
+        prefilter = filterConfig.get("prefilter")
+    weight = np.ones(passband.shape[1]) if prefilter is None else lookup_sorted(prefilter[:,0],prefilter[:,1],x[window])
+    throughput = passband @ weight
+    return x, profiles[1:], position[1:]-position[0], 1-throughput[1:]/throughput[0]
+
+
+def temperature_jacobian(filterConfig={},wavelength=None,cam="onband",cont="both",lcvrTemps=None,stages=5,
+                         iterations=8):
+    '''Analytic sensitivity of tuned passbands to each stage temperature, for a batch of tunings.
+
+    With a_s = k_s*(x - wavelength) + phase_s - offset_s and k_s = 2**s*pi/FSR the profile is prod_s cos^2(a_s).  The
+    passband peak solves sum_s k_s*tan(a_s) = 0, so by implicit differentiation
+        d(peak)/d(offset_s) = k_s*sec^2(a_s) / sum_r k_r^2*sec^2(a_r)
+    and the transmission at a fixed wavelength has
+        d(P)/d(offset_s) = sin(2a_s) * prod_{r!=s} cos^2(a_r).
+    offset_s = tempCof_s*(T_s - tempRef_s) turns these into per stage temperature derivatives.  Sum over stages for a
+    common temperature change of the whole filter.
+
+    wavelength (array): Tuning wavelengths, shape (n,).  cam/cont: one value or one per tuning (see createStages).
+    lcvrTemps (array): Stage temperatures to linearize at, (stages,) or (n, stages).  Defaults to tempRef.
+
+    The transmission is taken at the wavelength the tuning is meant to pass, the passband peak at tempRef (the tuning
+    for onband, the continuum peak for offband; for cont="both" offband the two continuum peaks are equal and the
+    first found is used).  For onband at tempRef that is the peak itself, where the first derivative vanishes and
+    the loss is second order, hence the hessian.
+
+    Returns (peak, dpeak_dT, dthroughput_dT, d2throughput_dT2):
+        peak (n,): Passband peak [nm] at lcvrTemps.
+        dpeak_dT (n, stages): [nm/C].
+        dthroughput_dT (n, stages): Change of the transmission (peak 1) [1/C].
+        d2throughput_dT2 (n, stages, stages): Its hessian [1/C^2].
+    '''
+    FSR = filterConfig.get("FSR",1)
+    if wavelength is None:
+        wavelength = filterConfig.get("region",0)
+    wavelength = np.atleast_1d(np.asarray(wavelength,dtype=np.float64))
+    n = wavelength.shape[0]
+    cams = [cam]*n if isinstance(cam,str) else list(cam)
+    conts = [cont]*n if isinstance(cont,str) else list(cont)
+    phase = np.array([tuningPhases(cam=c,cont=o,stages=stages) for c,o in zip(cams,conts)]).reshape(n,stages)
+    tempCof = np.broadcast_to(np.asarray(filterConfig.get("tempCof",0),dtype=np.float64),(stages,))
+    if lcvrTemps is None:
+        offsets = np.zeros((n,stages))
+    else:
+        offsets = np.broadcast_to(temperature_offsets(filterConfig,lcvrTemps),(n,stages))
+    k = 2.0**np.arange(stages)*np.pi/FSR
+
+    def angles(x,psi):
+        return k[None,:]*(x-wavelength)[:,None]+psi
+
+    def findPeak(start,psi):
+        x = start
+        for i in range(iterations):
+            a = angles(x,psi)
+            x = x-np.sum(k*np.tan(a),axis=1)/np.sum(k**2/np.cos(a)**2,axis=1)
+        return x
+
+    # Reference passband: highest sample of one FSR (256 samples resolve the FSR/32 main lobe), then Newton
+    delta = FSR*(np.arange(256)/256-0.5)
+    coarse = stageProduct(delta[None,:],FSR,phase,stages)
+    target = findPeak(wavelength+delta[np.argmax(coarse,axis=1)],phase)
+    psi = phase-offsets
+    peak = findPeak(target,psi)
+
+    a = angles(peak,psi)
+    secant = 1/np.cos(a)**2
+    dpeak = k*secant/np.sum(k**2*secant,axis=1)[:,None]
+
+    a = angles(target,psi)
+    cos2 = np.cos(a)**2
+    sin2a = np.sin(2*a)
+    others = np.empty((n,stages))
+    for s in range(stages):
+        others[:,s] = np.prod(np.delete(cos2,s,axis=1),axis=1)
+    dthroughput = sin2a*others
+    hessian = np.empty((n,stages,stages))
+    for s in range(stages):
+        for r in range(stages):
+            if r == s:
+                hessian[:,s,s] = -2*np.cos(2*a[:,s])*others[:,s]
+            else:
+                rest = np.prod(np.delete(cos2,[s,r],axis=1),axis=1)
+                hessian[:,s,r] = sin2a[:,s]*sin2a[:,r]*rest
+    return (peak,dpeak*tempCof,dthroughput*tempCof,hessian*tempCof[:,None]*tempCof[None,:])
+
+
+def gaussian_jacobian(x,amplitude,center,sigma,expon):
+    '''gaussian and its derivatives with respect to (amplitude, center, sigma, expon), for a batch of parameter sets.
+
+    x has shape (n_samples,) or (n_profiles, n_samples), the parameters shape (n_profiles,).
+    Returns the model (n_profiles, n_samples) and the jacobian (n_profiles, n_samples, 4).
+    '''
+    x = np.asarray(x,dtype=np.float64)
+    amplitude,center,sigma,expon = [np.asarray(p,dtype=np.float64)[:,None] for p in (amplitude,center,sigma,expon)]
+    delta = x-center
+    r = np.abs(delta)/sigma
+    rp = r**expon
+    shape = np.exp(-rp/2)/(np.sqrt(2*np.pi)*sigma)
+    model = amplitude*shape
+    # d(r^p)/dc = -p*r^(p-1)*sign(delta)/sigma, taken as 0 at r = 0 (expon >= 1 keeps it finite)
+    with np.errstate(divide="ignore",invalid="ignore"):
+        drp_dc = np.where(r > 0,-expon*rp/r*np.sign(delta)/sigma,0.0)
+        logr = np.where(r > 0,np.log(r),0.0)
+    jacobian = np.stack([shape,
+                         -model/2*drp_dc,
+                         model*(expon*rp/2-1)/sigma,
+                         -model/2*rp*logr],axis=-1)
+    return model, jacobian
+
+
+def fit_gaussians(x,profiles,fit_expon=True,iterations=30,initial=None,weights=None,min_expon=1.0,max_expon=20.0,
+                  chunk_size=1024,tolerance=1e-10):
+    '''Batched Levenberg-Marquardt fit of gaussian(x, amplitude, center, sigma, expon) to a stack of profiles.
+
+    Every profile is fitted at once: each iteration builds the (n, 4, 4) normal equations from the analytic jacobian
+    (gaussian_jacobian), solves them with one batched np.linalg.solve, and raises or lowers each profile's damping
+    depending on whether its step reduced the residual, so the work is a fixed number of array operations whatever
+    the number of profiles.  Iteration stops early once no profile changes its cost by more than tolerance relative.
+
+    x (array): Sample positions, (n_samples,) shared by all profiles or (n_profiles, n_samples).
+    profiles (array): (n_profiles, n_samples), or a single (n_samples,) profile.
+    fit_expon (bool): Fit the super-Gaussian exponent; False holds it at its initial value (2 unless given).
+    iterations (int): Maximum number of iterations.
+    initial (dict): Starting amplitude/center/sigma/expon arrays or scalars.  Missing entries are estimated from each
+                    profile: center at the highest sample, sigma from the width of the half maximum lobe around it,
+                    amplitude from the peak height.
+    weights (array): Per sample weights 1/error^2, broadcast against profiles.  Zero weights exclude samples, e.g. to
+                     fit only the main lobe of a Lyot profile.  With weights the uncertainties follow from the given
+                     errors, without them they are scaled by the residuals (reduced chi-square).
+    min_expon, max_expon: Bounds on the exponent, min_expon >= 1 keeps the center derivative finite.
+    chunk_size (int): Profiles per pass, bounding the jacobian to chunk_size x n_samples x 4 floats.
+
+    Returns a dict of (n_profiles,) arrays: amplitude, center, sigma, expon, their standard errors (amplitude_err,
+    center_err, sigma_err, expon_err; expon_err is 0 when not fitted), chi2 (weighted sum of squared residuals) and
+    converged (the final relative cost change was within tolerance).
+    '''
+    profiles = np.asarray(profiles,dtype=np.float64)
+    single = profiles.ndim == 1
+    profiles = np.atleast_2d(profiles)
+    n, m = profiles.shape
+    x = np.broadcast_to(np.asarray(x,dtype=np.float64),(n,m))
+    # Without measurement errors the uncertainties are scaled by the scatter of the residuals
+    scaled = weights is None
+    weights = np.broadcast_to(np.ones(1) if weights is None else np.asarray(weights,dtype=np.float64),(n,m))
+    names = ("amplitude","center","sigma","expon")
+    result = {name: np.empty(n) for name in names}
+    result.update({name+"_err": np.zeros(n) for name in names})
+    result["chi2"] = np.empty(n)
+    result["converged"] = np.zeros(n,dtype=bool)
+    free = np.array([True,True,True,fit_expon])
+
+    for start in range(0,n,max(int(chunk_size),1)):
+        rows = slice(start,start+chunk_size)
+        y, xs, w = profiles[rows], x[rows], weights[rows]
+        k = y.shape[0]
+        index = np.arange(k)
+        # Starting point from the highest sample and its half maximum lobe
+        peak = np.argmax(np.where(w > 0,y,-np.inf),axis=1)
+        height = y[index,peak]
+        inside = y >= height[:,None]/2
+        column = np.arange(m)[None,:]
+        right = np.min(np.where(~inside & (column > peak[:,None]),column,m),axis=1)-1
+        left = np.max(np.where(~inside & (column < peak[:,None]),column,-1),axis=1)+1
+        fwhm = np.maximum(np.abs(xs[index,right]-xs[index,left]),np.abs(xs[:,1]-xs[:,0]))
+        guess = {"center": xs[index,peak], "sigma": fwhm/(2*np.sqrt(2*np.log(2))), "expon": np.full(k,2.0)}
+        guess["amplitude"] = height*np.sqrt(2*np.pi)*guess["sigma"]
+        if initial is not None:
+            for name in names:
+                if name in initial:
+                    guess[name] = np.broadcast_to(np.asarray(initial[name],dtype=np.float64),(n,))[rows].copy()
+        params = np.stack([guess[name] for name in names],axis=1)
+        params[:,3] = np.clip(params[:,3],min_expon,max_expon)
+
+        def evaluate(p):
+            model, jacobian = gaussian_jacobian(xs,*p.T)
+            residual = y-model
+            return residual, jacobian, np.sum(w*residual**2,axis=1)
+
+        residual, jacobian, cost = evaluate(params)
+        damping = np.full(k,1e-3)
+        converged = np.zeros(k,dtype=bool)
+        for iteration in range(iterations):
+            weighted = np.swapaxes(jacobian*free*w[:,:,None],1,2)
+            normal = weighted @ (jacobian*free)
+            gradient = (weighted @ residual[:,:,None])[:,:,0]
+            diagonal = np.diagonal(normal,axis1=1,axis2=2)
+            # Fixed parameters get a unit diagonal so the system stays solvable with a zero step
+            scale = np.where(free,diagonal,1.0)
+            damped = normal+(damping[:,None]*scale)[:,:,None]*np.eye(4)+np.diag(~free*1.0)
+            step = np.linalg.solve(damped,gradient[:,:,None])[:,:,0]
+            trial = params+step
+            trial[:,2] = np.abs(trial[:,2])
+            trial[:,3] = np.clip(trial[:,3],min_expon,max_expon)
+            trial_residual, trial_jacobian, trial_cost = evaluate(trial)
+            better = np.isfinite(trial_cost) & (trial_cost <= cost)
+            change = np.abs(cost-np.where(better,trial_cost,cost))
+            converged |= better & (change <= tolerance*np.maximum(cost,np.finfo(float).tiny))
+            params = np.where(better[:,None],trial,params)
+            residual = np.where(better[:,None],trial_residual,residual)
+            jacobian = np.where(better[:,None,None],trial_jacobian,jacobian)
+            cost = np.where(better,trial_cost,cost)
+            damping = np.where(better,damping/10,damping*10)
+            if np.all(converged | (damping > 1e12)):
+                break
+
+        # Covariance from the undamped normal equations at the solution
+        jacobian = jacobian*free
+        normal = np.swapaxes(jacobian*w[:,:,None],1,2) @ jacobian+np.diag(~free*1.0)
+        covariance = np.linalg.pinv(normal)
+        if scaled:
+            dof = max(m-int(np.sum(free)),1)
+            covariance = covariance*(cost/dof)[:,None,None]
+        errors = np.sqrt(np.clip(np.diagonal(covariance,axis1=1,axis2=2),0,None))*free
+        for i,name in enumerate(names):
+            result[name][rows] = params[:,i]
+            result[name+"_err"][rows] = errors[:,i]
+        result["chi2"][rows] = cost
+        result["converged"][rows] = converged
+    if single:
+        result = {name: value[0] for name,value in result.items()}
+    return result
+
 '''
 Pulls the relevant lyot filter config data out of a tuning_calibration ini file and puts it in a dictoary for 
 use by createStages function.
@@ -136,6 +851,232 @@ def getFilterConfig(filename):
         tempRef.append(ref[i])
         tempCof.append(cof[i])
     return {"FSR":FSR,"region":region,"tempCof":tempCof,"tempRef":tempRef}
+
+
+class NaturalSpline:
+    '''Natural cubic spline through (x, y), x strictly increasing: zero second derivative at both ends, the default of
+    the IDL spl_init/spl_interp pair.  The second derivatives are solved once, evaluation is vectorized; outside the
+    knots the end cubic is extrapolated.'''
+
+    def __init__(self,x,y):
+        self.x = np.asarray(x,dtype=np.float64)
+        self.y = np.asarray(y,dtype=np.float64)
+        h = np.diff(self.x)
+        n = self.x.shape[0]
+        system = np.eye(n)
+        rhs = np.zeros(n)
+        for i in range(1,n-1):
+            system[i,i-1:i+2] = [h[i-1]/6,(h[i-1]+h[i])/3,h[i]/6]
+            rhs[i] = (self.y[i+1]-self.y[i])/h[i]-(self.y[i]-self.y[i-1])/h[i-1]
+        self.y2 = np.linalg.solve(system,rhs)
+
+    def __call__(self,values):
+        values = np.asarray(values,dtype=np.float64)
+        i = np.clip(np.searchsorted(self.x,values)-1,0,self.x.shape[0]-2)
+        h = self.x[i+1]-self.x[i]
+        a = (self.x[i+1]-values)/h
+        b = 1-a
+        return a*self.y[i]+b*self.y[i+1]+((a**3-a)*self.y2[i]+(b**3-b)*self.y2[i+1])*h**2/6
+
+    def derivative(self,values):
+        values = np.asarray(values,dtype=np.float64)
+        i = np.clip(np.searchsorted(self.x,values)-1,0,self.x.shape[0]-2)
+        h = self.x[i+1]-self.x[i]
+        a = (self.x[i+1]-values)/h
+        b = 1-a
+        return (self.y[i+1]-self.y[i])/h+((1-3*a**2)*self.y2[i]+(3*b**2-1)*self.y2[i+1])*h/6
+
+    def inverse(self,values,iterations=8):
+        '''x where the spline equals values, for a spline increasing with x (y increasing at the knots).  The knot
+        interval comes from a binary search of y, then Newton steps kept inside that interval; values beyond the end
+        knots solve the extrapolated end cubic.'''
+        values = np.asarray(values,dtype=np.float64)
+        n = self.x.shape[0]
+        i = np.clip(np.searchsorted(self.y,values)-1,0,n-2)
+        low = np.where(i == 0,-np.inf,self.x[i])
+        high = np.where(i == n-2,np.inf,self.x[i+1])
+        x = self.x[i]+(values-self.y[i])/(self.y[i+1]-self.y[i])*(self.x[i+1]-self.x[i])
+        for iteration in range(iterations):
+            x = np.clip(x-(self(x)-values)/self.derivative(x),low,high)
+        return x
+
+
+'''
+Phase to voltage tuning, following config/Lyot-phase-to-voltage.md.  For each stage s (in ini order, Stage0..Stage4)
+
+diff = wavelength - reference_wavelength - wavelength_offset
+phase_s = (diff/period_s - round(diff/period_s))*pi
+phase_4 += pi/2 when RCAM is the onband camera, phase_0 -/+ pi/8 for BLUE/RED continuum
+phase_s -= (temp_s - reference_temp_s)*temp_coefficient_s      (temperature correction, when temperatures are given)
+phase_s moved into the range of the Stage phase table by adding or subtracting pi
+voltage_s = spline of the [Voltages] table against the Stage phase table, at phase_s
+
+(The worked example in that document evaluates diff as reference - recipe - offset; the equation above is the
+one it states for the real-time code.)
+'''
+class VoltageTable:
+    '''Phase/voltage calibration of one tuning_calibration ini file, parsed once with the spline of every stage ready.
+
+    filename: Path of the ini file, relative to gitDirectory like getFilterConfig.
+    '''
+
+    def __init__(self,filename):
+        import configparser
+        ini = configparser.ConfigParser()
+        if not ini.read(gitDirectory / filename):
+            raise FileNotFoundError(f"Tuning calibration not found: {gitDirectory / filename}")
+        main = ini["Main"]
+        self.filename = filename
+        self.reference_wavelength = float(main["reference_wavelength"])
+        self.wavelength_offset = float(main.get("wavelength_offset","0"))
+        count = int(main["number_of_voltages"])
+        self.voltages = np.array([float(ini["Voltages"][f"voltage{i:02d}"]) for i in range(count)])
+        stages = sorted(name for name in ini.sections() if name.startswith("Stage"))
+        self.period = np.array([float(ini[name]["period"]) for name in stages])
+        self.temp_coefficient = np.array([float(ini[name]["temp_coefficient"]) for name in stages])
+        self.reference_temp = np.array([float(ini[name]["reference_temp"]) for name in stages])
+        self.sensor = [ini[name].get("sensor","").strip() for name in stages]
+        self.phases = np.array([[float(ini[name][f"phase{i:02d}"]) for i in range(count)] for name in stages])
+        self.splines = [NaturalSpline(phase,self.voltages) for phase in self.phases]
+
+    @property
+    def stages(self):
+        return self.period.shape[0]
+
+    def stage_phases(self,wavelength,onband="tcam",cont="both",lcvrTemps=None,wavelength_offset=None):
+        '''Tuning phase of every stage, wrapped into the range of its phase table.
+
+        wavelength (float or array): Recipe tuning wavelengths [nm], shape (n,).
+        onband (enum "tcam","rcam"): Camera that sees the emission line, one value or one per tuning.
+        cont (enum "both","red","blue"): Continuum selection, one value or one per tuning.
+        lcvrTemps (array): Stage temperatures [C] in Stage0..Stage4 order, (stages,) or (n, stages).  None applies no
+                           temperature correction (T_COMPS off).
+        wavelength_offset (float): Overrides the ini wavelength_offset, e.g. an updated sky calibration.
+
+        Returns the phases [rad], shape (n, stages).
+        '''
+        wavelength = np.atleast_1d(np.asarray(wavelength,dtype=np.float64))
+        n = wavelength.shape[0]
+        offset = self.wavelength_offset if wavelength_offset is None else wavelength_offset
+        diff = wavelength-self.reference_wavelength-offset
+        waves = diff[:,None]/self.period[None,:]
+        phase = (waves-np.round(waves))*np.pi
+        onband = np.char.lower(np.broadcast_to(np.asarray(onband,dtype=str),(n,)))
+        cont = np.char.lower(np.broadcast_to(np.asarray(cont,dtype=str),(n,)))
+        phase[:,self.stages-1] += np.where(onband == "rcam",np.pi/2,0.0)
+        phase[:,0] += np.where(cont == "blue",-np.pi/8,np.where(cont == "red",np.pi/8,0.0))
+        if lcvrTemps is not None:
+            temps = np.broadcast_to(np.asarray(lcvrTemps,dtype=np.float64),(n,self.stages))
+            phase = phase-(temps-self.reference_temp)*self.temp_coefficient
+        low = self.phases.min(axis=1)
+        high = self.phases.max(axis=1)
+        phase = phase+np.pi*np.ceil(np.maximum(low-phase,0)/np.pi)
+        phase = phase-np.pi*np.ceil(np.maximum(phase-high,0)/np.pi)
+        return phase
+
+    def stage_voltages(self,wavelength,onband="tcam",cont="both",lcvrTemps=None,wavelength_offset=None):
+        '''Voltages [V] of every stage, shape (n, stages); arguments as stage_phases.'''
+        phase = self.stage_phases(wavelength,onband=onband,cont=cont,lcvrTemps=lcvrTemps,
+                                  wavelength_offset=wavelength_offset)
+        return np.stack([spline(phase[:,s]) for s,spline in enumerate(self.splines)],axis=1)
+
+    def voltage_phases(self,voltages):
+        '''Inverse of the stage splines: phase [rad] of every stage for voltages (n, stages).'''
+        voltages = np.atleast_2d(np.asarray(voltages,dtype=np.float64))
+        return np.stack([spline.inverse(voltages[:,s]) for s,spline in enumerate(self.splines)],axis=1)
+
+    def recover_tuning(self,voltages,lcvrTemps=None,wavelength_offset=None,center=None):
+        '''Tuning wavelength, onband camera and continuum implied by recorded stage voltages, for a batch of frames.
+
+        Each stage only fixes pi*diff/period_s + shift_s modulo pi (shift_s being the RCAM and RED/BLUE phase
+        shifts), so for every onband/cont candidate the phases are unwrapped from the longest period down: the longest
+        stage places diff within one of its periods around center, each shorter stage then picks the multiple of pi
+        that agrees with the estimate so far, and diff is the least-squares fit of pi*diff/period_s to all unwrapped
+        phases.  The candidate with the smallest rms phase residual wins.
+
+        voltages (array): Stage voltages [V], (n, stages) in Stage0..Stage4 order.
+        lcvrTemps (array): Stage temperatures [C], (stages,) or (n, stages), when the tuning was temperature
+                           corrected (T_COMPS on).  None assumes no correction.
+        wavelength_offset (float): Overrides the ini wavelength_offset the tuning was computed with.
+        center (float): Wavelength the search is centred on (within half the longest period), default
+                        reference_wavelength.
+
+        Returns a dict of (n,) arrays: wavelength [nm], onband ("tcam"/"rcam"), cont ("both"/"red"/"blue"),
+        residual (rms phase residual of the best candidate [rad]) and margin (residual of the runner up minus that
+        of the best, small values mean the cam/cont choice is ambiguous).
+        '''
+        phase = self.voltage_phases(voltages)
+        n = phase.shape[0]
+        if lcvrTemps is not None:
+            temps = np.broadcast_to(np.asarray(lcvrTemps,dtype=np.float64),(n,self.stages))
+            phase = phase+(temps-self.reference_temp)*self.temp_coefficient
+        offset = self.wavelength_offset if wavelength_offset is None else wavelength_offset
+        center = self.reference_wavelength if center is None else center
+        centerDiff = center-self.reference_wavelength-offset
+        k = np.pi/self.period
+        order = np.argsort(self.period)[::-1]
+
+        candidates = [(cam,cont) for cam in ("tcam","rcam") for cont in ("both","red","blue")]
+        diffs = np.empty((len(candidates),n))
+        residuals = np.empty((len(candidates),n))
+        for c,(cam,cont) in enumerate(candidates):
+            shift = np.zeros(self.stages)
+            if cam == "rcam":
+                shift[self.stages-1] = np.pi/2
+            shift[0] += {"both":0.0,"red":np.pi/8,"blue":-np.pi/8}[cont]
+            measured = phase-shift
+            first = order[0]
+            wrapped = measured[:,first]-k[first]*centerDiff
+            diff = centerDiff+(wrapped-np.pi*np.round(wrapped/np.pi))/k[first]
+            unwrapped = np.empty((n,self.stages))
+            for j,s in enumerate(order):
+                unwrapped[:,s] = measured[:,s]+np.pi*np.round((k[s]*diff-measured[:,s])/np.pi)
+                used = order[:j+1]
+                diff = unwrapped[:,used] @ k[used]/np.sum(k[used]**2)
+            diffs[c] = diff
+            residuals[c] = np.sqrt(np.mean((k[None,:]*diff[:,None]-unwrapped)**2,axis=1))
+        ranked = np.argsort(residuals,axis=0)
+        best = ranked[0]
+        columns = np.arange(n)
+        return {"wavelength": diffs[best,columns]+self.reference_wavelength+offset,
+                "onband": np.array([candidates[c][0] for c in best]),
+                "cont": np.array([candidates[c][1] for c in best]),
+                "residual": residuals[best,columns],
+                "margin": residuals[ranked[1],columns]-residuals[best,columns]}
+
+
+_voltageTables = {}
+
+def getVoltageTable(filename):
+    '''VoltageTable for an ini file, parsed on first use and reused after.'''
+    key = str(Path(gitDirectory / filename).resolve())
+    if key not in _voltageTables:
+        _voltageTables[key] = VoltageTable(filename)
+    return _voltageTables[key]
+
+
+def tuning_voltages(tables,wavelength,onband="tcam",cont="both",lcvrTemps=None):
+    '''Stage voltages for tunings spread over several wave regions, e.g. every DATA line of the recipe library.
+
+    tables (list): VoltageTables of the regions; each tuning uses the one with the nearest reference_wavelength.
+    Other arguments as VoltageTable.stage_phases, with per tuning values allowed for all of them.
+
+    Returns the voltages (n, stages) and the index into tables used for each tuning.
+    '''
+    wavelength = np.atleast_1d(np.asarray(wavelength,dtype=np.float64))
+    n = wavelength.shape[0]
+    references = np.array([table.reference_wavelength for table in tables])
+    region = np.argmin(np.abs(wavelength[:,None]-references[None,:]),axis=1)
+    onband = np.broadcast_to(np.asarray(onband,dtype=str),(n,))
+    cont = np.broadcast_to(np.asarray(cont,dtype=str),(n,))
+    temps = None if lcvrTemps is None else np.broadcast_to(np.asarray(lcvrTemps,dtype=np.float64),
+                                                           (n,tables[0].stages))
+    result = np.empty((n,tables[0].stages))
+    for i in np.unique(region):
+        rows = region == i
+        result[rows] = tables[i].stage_voltages(wavelength[rows],onband=onband[rows],cont=cont[rows],
+                                                lcvrTemps=None if temps is None else temps[rows])
+    return result, region
  
  
 
@@ -143,6 +1084,58 @@ def find_nearest(array,value):
     return (np.abs(array-value)).argmin()
 
 
+def find_nearest_sorted(array,values):
+    '''Vectorized find_nearest for an array sorted in ascending order (e.g. the Kitt Peak atlas or a prefilter
+    wavelength column).  Uses a binary search per value instead of a full scan, and returns the same index
+    find_nearest would: on ties and repeated values the lowest index wins.
+
+    array (1d array): Sorted values to search.
+    values (float or array): Values to look up.
+
+    Returns an integer index array with the shape of values.
+    '''
+    array = np.asarray(array)
+    values = np.asarray(values)
+    right = np.clip(np.searchsorted(array,values,side="left"),0,len(array)-1)
+    left = np.clip(right-1,0,None)
+    # First occurrence of the left neighbour value, matching argmin on repeated values.
+    left = np.searchsorted(array,array[left],side="left")
+    use_left = np.abs(array[left]-values) <= np.abs(array[right]-values)
+    return np.where(use_left,left,right)
+
+
+def lookup_sorted(x,y,values,method="nearest"):
+    '''Sample a tabulated function y(x) at many points at once.  x must be sorted in ascending order.
+
+    method (enum "nearest","linear"): "nearest" reproduces the y[find_nearest(x,value)] loops used by the
+                                      validators, "linear" interpolates with np.interp.
+    '''
+    if method == "nearest":
+        return np.asarray(y)[find_nearest_sorted(x,values)]
+    if method == "linear":
+        return np.interp(values,x,y)
+    raise ValueError(f"Unknown lookup method: {method}")
+
+
+def weight_profiles(x,profiles,table,method="nearest"):
+    '''Weight a profile, or a whole stack of profiles sharing the grid x, by a tabulated filter such as the prefilter.
+    The table is sampled at x once and every row is weighted in one multiply.
+
+    x (1d array): Wavelength grid of the profiles (e.g. from createStagesBatch).
+    profiles (array): Profile (n_samples,) or stack of profiles (n_tunings, n_samples).
+    table (2d array): Wavelength and transmission columns, e.g. config["prefilter"].  Tables not sorted by wavelength
+                      are sorted first (stable, so repeated wavelengths keep their order).
+    method (enum "nearest","linear"): "nearest" reproduces the find_nearest loop convolve_filters used exactly,
+                                      "linear" interpolates the table with np.interp as in test.ipynb.
+
+    Returns a new array shaped like profiles.
+    '''
+    table = np.asarray(table)
+    if np.any(np.diff(table[:,0]) < 0):
+        table = table[np.argsort(table[:,0],kind="stable")]
+    return np.asarray(profiles)*lookup_sorted(table[:,0],table[:,1],x,method=method)
+
+
 def UCoMPGetDailyFlatList(obsDate,waveRegion):
     flatLocation = f"{getRoute(obsDate, 'ucomp-process')}/{obsDate}/*flat.files.txt"
    # print(glob.glob(flatLocation))
@@ -0,0 +1,214 @@
+"""
+Passband metrics of every recipe tuning
+
+The tuning plots in Recipes/tuningplots show each DATA tuning of a recipe as
+its Lyot profile weighted by the prefilter (``convolve_filters``), for the
+onband and the offband camera.  This module computes the numbers read off
+those plots, for every distinct (region, tuning wavelength, cam, cont) used
+in Recipes/scripts, in one batch per region:
+
+  * throughput: sum(prefilter*profile)/sum(profile)/100, the legend value
+  * peak, peak_wavelength: highest point of the weighted profile [%, nm]
+  * fwhm: full width at half maximum of that highest lobe [nm]
+  * centroid_offset: weighted centroid minus the tuning wavelength [nm]
+  * leakage: fraction of the weighted transmission outside the nominal
+    passbands, i.e. farther than FSR/2**stages (the first null of the main
+    lobe) from the tuning (onband) or from tuning -/+ FSR/4 (offband)
+
+Every profile of a region shares the createStages grid, so the prefilter is
+sampled once per region and each metric is one array operation over the
+stack of profiles from createStagesTemplated.
+
+Usage:
+    from passband_metrics import recipe_tunings, metrics_table, write_metrics_table
+    rows = metrics_table(tuning_configs, recipe_tunings("Recipes/scripts"))
+    write_metrics_table(rows, "Recipes/passband_metrics.csv")
+
+    python passband_metrics.py                       # Recipes/passband_metrics.csv
+    python passband_metrics.py --sort leakage        # and print the worst tunings
+"""
+
+import csv
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from mlso_utils import createStagesTemplated, find_nearest, weight_profiles
+from recipe_data import read_data_lines
+
+RECIPES_DIR = Path(__file__).resolve().parent.parent / "Recipes"
+METRICS_FILE = "passband_metrics.csv"
+CAMS = ("onband", "offband")
+COLUMNS = ("region", "wavelength", "cont", "cam", "throughput", "peak", "peak_wavelength", "fwhm",
+           "centroid_offset", "leakage", "recipes")
+# Tuning wavelengths are rounded to this many decimals [nm], as in profile_cache
+WAVELENGTH_DECIMALS = 4
+
+
+def recipe_tunings(scripts_dir: Union[Path, str] = RECIPES_DIR / "scripts") -> Dict[Tuple[float, str], Set[str]]:
+    """DATA tunings of every .rcp recipe
+
+    Args:
+        scripts_dir: Directory of the recipe files
+
+    Returns:
+        Dict of (wavelength, cont) to the names of the recipes using it, with
+        cont lower case as passed to createStages
+    """
+    tunings: Dict[Tuple[float, str], Set[str]] = {}
+    for line in read_data_lines(scripts_dir):
+        tunings.setdefault((round(line.wavelength, WAVELENGTH_DECIMALS), line.cont), set()).add(line.recipe)
+    return tunings
+
+
+def region_for(wavelength: float, tuning_configs: Dict[str, Dict]) -> str:
+    """Region key nearest to a tuning wavelength, as the validators pick it"""
+    keys = list(tuning_configs)
+    return keys[find_nearest(np.array(keys, dtype=np.uint16), wavelength)]
+
+
+def _half_max_edges(weighted: np.ndarray, x: np.ndarray, peak: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Wavelengths where each row first falls below half its maximum on
+    either side of the peak, interpolated between samples (grid ends when the
+    lobe runs off the grid)"""
+    rows = np.arange(weighted.shape[0])
+    n = weighted.shape[1]
+    half = weighted[rows, peak] / 2
+    index = np.arange(n)[None, :]
+    below = weighted < half[:, None]
+    right = np.min(np.where(below & (index > peak[:, None]), index, n), axis=1)
+    left = np.max(np.where(below & (index < peak[:, None]), index, -1), axis=1)
+
+    def crossing(outside, inside, edge):
+        found = (outside >= 0) & (outside < n)
+        outside = np.clip(outside, 0, n - 1)
+        a, b = weighted[rows, inside], weighted[rows, outside]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.where(a != b, (a - half) / (a - b), 0.0)
+        position = x[inside] + fraction * (x[outside] - x[inside])
+        return np.where(found, position, edge)
+
+    return (crossing(left, np.clip(left + 1, 0, n - 1), x[0]),
+            crossing(right, np.clip(right - 1, 0, n - 1), x[-1]))
+
+
+def passband_metrics(config: Dict, wavelength: Iterable[float], cam: Union[str, List[str]] = "onband",
+                     cont: Union[str, List[str]] = "both", stages: int = 5,
+                     chunk_size: Optional[int] = 64) -> Dict[str, np.ndarray]:
+    """Metrics of the prefilter weighted profiles of many tunings of a region
+
+    Args:
+        config: Region config from getFilterConfig with a "prefilter" table
+        wavelength: Tuning wavelengths [nm]
+        cam, cont: One selection for every tuning, or one per tuning
+        stages: Number of Lyot stages
+        chunk_size: Tunings evaluated at a time, see createStagesBatch
+
+    Returns:
+        Dict of metric name (see the module docstring) to an array with one
+        entry per tuning
+    """
+    wavelength = np.atleast_1d(np.asarray(wavelength, dtype=np.float64))
+    n = wavelength.shape[0]
+    cams = [cam] * n if isinstance(cam, str) else list(cam)
+    FSR = config["FSR"]
+    x, profiles = createStagesTemplated(filterConfig=config, wavelength=wavelength, cam=cams, cont=cont,
+                                        stages=stages, chunk_size=chunk_size)
+    weighted = weight_profiles(x, profiles, config["prefilter"], method="nearest")
+    total = np.sum(weighted, axis=1)
+
+    peak = np.argmax(weighted, axis=1)
+    low, high = _half_max_edges(weighted, x, peak)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        centroid = np.where(total > 0, weighted @ x / total, wavelength)
+
+    # Nominal passband centres: the tuning, or the two continuum positions FSR/4 either side of it
+    offband = np.array([c == "offband" for c in cams])[:, None]
+    distance = np.abs(x[None, :] - wavelength[:, None])
+    distance = np.where(offband, np.abs(distance - FSR / 4), distance)
+    inband = np.sum(np.where(distance <= FSR / 2**stages, weighted, 0.0), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        leakage = np.where(total > 0, 1 - inband / total, 0.0)
+
+    return {"throughput": total / np.sum(profiles, axis=1) / 100,
+            "peak": weighted[np.arange(n), peak],
+            "peak_wavelength": x[peak],
+            "fwhm": high - low,
+            "centroid_offset": centroid - wavelength,
+            "leakage": leakage}
+
+
+def metrics_table(tuning_configs: Dict[str, Dict], tunings: Dict[Tuple[float, str], Set[str]],
+                  cams: Iterable[str] = CAMS, stages: int = 5) -> List[Dict]:
+    """One row of metrics per (region, wavelength, cont, cam)
+
+    Args:
+        tuning_configs: Region configs by region key; regions without a
+                        "prefilter" table are skipped, as in the tuning plots
+        tunings: Output of recipe_tunings
+        cams: Camera selections to evaluate for every tuning
+        stages: Number of Lyot stages
+
+    Returns:
+        List of row dicts with the COLUMNS keys, sorted by region, wavelength,
+        cont and cam
+    """
+    by_region: Dict[str, List[Tuple[float, str, str]]] = {}
+    for (wavelength, cont) in sorted(tunings):
+        region = region_for(wavelength, tuning_configs)
+        if "prefilter" not in tuning_configs[region]:
+            logging.info(f"No prefilter for region {region}, skipping {wavelength} {cont}")
+            continue
+        for cam in cams:
+            by_region.setdefault(region, []).append((wavelength, cont, cam))
+
+    rows = []
+    for region, selections in by_region.items():
+        waves, conts, cams_ = zip(*selections)
+        metrics = passband_metrics(tuning_configs[region], waves, cam=list(cams_), cont=list(conts), stages=stages)
+        for i, (wavelength, cont, cam) in enumerate(selections):
+            row = {"region": region, "wavelength": wavelength, "cont": cont, "cam": cam,
+                   "recipes": ";".join(sorted(tunings[(wavelength, cont)]))}
+            row.update({name: float(values[i]) for name, values in metrics.items()})
+            rows.append(row)
+    rows.sort(key=lambda row: (float(row["region"]), row["wavelength"], row["cont"], row["cam"]))
+    return rows
+
+
+def write_metrics_table(rows: List[Dict], path: Union[Path, str]) -> None:
+    """Write metrics_table rows as CSV (lengths in nm, 6 significant digits)"""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow([f"{row[name]:.6g}" if isinstance(row[name], float) else row[name]
+                             for name in COLUMNS])
+
+
+if __name__ == "__main__":
+    import argparse
+    from throughput_grid import RESOURCE_DIR, region_configs
+    parser = argparse.ArgumentParser(description="Passband metrics of every tuning used in the recipes")
+    parser.add_argument("--recipes-dir", type=Path, default=RECIPES_DIR,
+                        help="Recipes directory (recipes are read from its scripts folder)")
+    parser.add_argument("--resource-dir", type=Path, default=RESOURCE_DIR,
+                        help="Directory holding the ini and prefilter files")
+    parser.add_argument("-o", "--output", type=Path, default=None,
+                        help=f"Output CSV (default: <recipes-dir>/{METRICS_FILE})")
+    parser.add_argument("--no-atlas", action="store_true",
+                        help="Weight by the prefilter only, without the Kitt Peak atlas")
+    parser.add_argument("--sort", choices=COLUMNS[4:-1], default=None,
+                        help="Print the ten tunings with the largest value of this metric")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    configs = region_configs(args.resource_dir, atlas=not args.no_atlas)
+    rows = metrics_table(configs, recipe_tunings(args.recipes_dir / "scripts"))
+    output = args.output or args.recipes_dir / METRICS_FILE
+    write_metrics_table(rows, output)
+    print(f"Wrote {len(rows)} tunings to {output}")
+    if args.sort:
+        for row in sorted(rows, key=lambda row: abs(row[args.sort]), reverse=True)[:10]:
+            print(f"{row['region']:>5} {row['wavelength']:9.3f} {row['cont']:>4} {row['cam']:>7} "
+                  f"{args.sort} {row[args.sort]:.4g}  {row['recipes']}")
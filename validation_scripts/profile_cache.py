@@ -0,0 +1,289 @@
+"""
+Tuning profile cache
+
+The validators draw every DATA tuning of a recipe as a Lyot profile weighted
+by the prefilter (``convolve_filters``), and most recipes share tunings, so
+the weighted profiles are kept between recipes.  ``ProfileCache`` holds them
+under structured keys (region, wavelength, cam, cont and a hash of the region
+config, so a changed ini or prefilter never returns a stale profile), evicts
+the least recently used profiles once a byte budget is exceeded, and counts
+hits, misses and evictions.
+
+With a ``ProfileStore`` attached the cache is also persistent: every region
+keeps one ``resource/profile_cache/<region>.npz`` holding its profiles and
+the config hash they were computed with.  A file whose hash no longer matches
+(the ini, the prefilter CSV or the atlas slice folded into the prefilter
+changed, or PROFILE_VERSION was bumped) is ignored and rewritten, so an
+unchanged tree computes no profiles at all on a warm run.
+
+Usage:
+    from profile_cache import ProfileCache, ProfileKey, config_hash
+    cache = ProfileCache(max_bytes=64 * 2**20)
+    key = ProfileKey("1074", 1074.7, "onband", "both", config_hash(config))
+    profile = cache.get(key)
+    if profile is None:
+        profile = convolve_filters(1074.7, config)
+        cache.put(key, profile)
+
+    cache = ProfileCache(store=ProfileStore())   # persistent
+    ...
+    cache.flush()                                # write new profiles to disk
+"""
+
+import os
+import hashlib
+import logging
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple, Union
+
+# A (wavelength, transmission) pair of the createStages grid is ~80 kB, so the
+# default budget holds a few thousand profiles
+DEFAULT_MAX_BYTES = 256 * 2**20
+# Tuning wavelengths are rounded to this many decimals [nm] in keys, so the
+# float32 and float64 parse of the same recipe value share an entry
+WAVELENGTH_DECIMALS = 4
+RESOURCE_DIR = Path(__file__).resolve().parent.parent / "resource"
+STORE_DIR_NAME = "profile_cache"
+# Bump when the profile computation changes, to invalidate every stored file
+PROFILE_VERSION = 1
+
+
+@dataclass(frozen=True)
+class ProfileKey:
+    """Identity of one prefilter weighted tuning profile"""
+    region: str
+    wavelength: float
+    cam: str
+    cont: str
+    config_hash: str
+    # "weighted" for convolve_filters output, "lyot" for the bare filter profile
+    kind: str = "weighted"
+
+    @classmethod
+    def make(cls, region: str, wavelength: float, cam: str, cont: str,
+             config_hash: str, kind: str = "weighted") -> "ProfileKey":
+        """Build a key with the wavelength rounded and the selections lower case"""
+        return cls(str(region), round(float(wavelength), WAVELENGTH_DECIMALS),
+                   cam.lower(), cont.lower(), config_hash, kind)
+
+
+def config_hash(config: Dict) -> str:
+    """Content hash of a region config from getFilterConfig
+
+    Covers every entry (FSR, region, temperature calibration, the prefilter
+    table and anything else stored in the dict), so any change to the ini or
+    the prefilter/atlas tables gives a different hash.
+
+    Args:
+        config: Region configuration dict
+
+    Returns:
+        Hex digest (16 characters)
+    """
+    digest = hashlib.sha256()
+    for name in sorted(config):
+        value = np.ascontiguousarray(config[name])
+        digest.update(name.encode())
+        digest.update(str(value.dtype).encode())
+        digest.update(str(value.shape).encode())
+        digest.update(value.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _nbytes(value: Tuple[np.ndarray, ...]) -> int:
+    return sum(np.asarray(part).nbytes for part in value)
+
+
+class ProfileStore:
+    """On-disk profiles, one ``.npz`` per region
+
+    Each file holds the config hash and PROFILE_VERSION it was written with,
+    and the profiles grouped by wavelength grid (the createStages grid is
+    shared by every tuning of a region, so it is stored once per group).
+    """
+
+    def __init__(self, cache_dir: Optional[Union[Path, str]] = None):
+        """
+        Args:
+            cache_dir: Directory of the region files, defaults to
+                       resource/profile_cache
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir else RESOURCE_DIR / STORE_DIR_NAME
+
+    def path(self, region: str) -> Path:
+        return self.cache_dir / f"{region}.npz"
+
+    def load(self, region: str, config_hash: str) -> Dict[ProfileKey, Tuple[np.ndarray, ...]]:
+        """Profiles stored for a region, empty if missing or stale
+
+        Args:
+            region: Region key (e.g. "1074")
+            config_hash: Current config_hash of the region
+
+        Returns:
+            Dict of ProfileKey to (wavelength, transmission)
+        """
+        path = self.path(region)
+        if not path.exists():
+            return {}
+        try:
+            with np.load(path) as data:
+                if str(data["config_hash"]) != config_hash or int(data["version"]) != PROFILE_VERSION:
+                    logging.info(f"Profile cache for {region} is stale, recomputing")
+                    return {}
+                entries = {}
+                for group in range(int(data["groups"])):
+                    grid = data[f"grid{group}"]
+                    trans = data[f"trans{group}"]
+                    for (wavelength, cam, cont, kind), row in zip(data[f"keys{group}"], trans):
+                        key = ProfileKey.make(region, float(wavelength), str(cam), str(cont),
+                                              config_hash, str(kind))
+                        entries[key] = (grid, row)
+                return entries
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable profile cache {path}: {e}")
+            return {}
+
+    def save(self, region: str, config_hash: str,
+             entries: Dict[ProfileKey, Tuple[np.ndarray, ...]]) -> None:
+        """Replace the region file with these profiles"""
+        grids = []
+        groups = []
+        for key, (wave, trans) in entries.items():
+            for grid, members in zip(grids, groups):
+                if grid.shape == wave.shape and np.array_equal(grid, wave):
+                    members.append((key, trans))
+                    break
+            else:
+                grids.append(np.asarray(wave))
+                groups.append([(key, trans)])
+        arrays = {"config_hash": np.array(config_hash), "version": np.array(PROFILE_VERSION),
+                  "groups": np.array(len(groups))}
+        for group, (grid, members) in enumerate(zip(grids, groups)):
+            arrays[f"grid{group}"] = grid
+            arrays[f"trans{group}"] = np.stack([trans for key, trans in members])
+            arrays[f"keys{group}"] = np.array([(f"{key.wavelength:.{WAVELENGTH_DECIMALS}f}", key.cam, key.cont, key.kind)
+                                               for key, trans in members])
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path(region).with_suffix(".tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.path(region))
+
+
+class ProfileCache:
+    """LRU cache of tuning profiles bounded in bytes
+
+    Values are tuples of arrays, normally the (wavelength, transmission) pair
+    returned by convolve_filters.  ``get`` counts a hit or a miss and marks
+    the entry as recently used; ``put`` evicts least recently used entries
+    until the cache fits in ``max_bytes`` again.
+
+    With a ``store`` a memory miss falls back to the region file on disk (a
+    disk hit).  Profiles put since the last ``flush`` are written back to
+    their region files by ``flush``, which also runs by itself once they
+    exceed ``max_bytes``.  Region files are read once and dropped again on
+    flush, so memory stays of the order of the budget plus the largest region
+    file.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES,
+                 store: Optional[ProfileStore] = None):
+        self.max_bytes = max_bytes
+        self.store = store
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[ProfileKey, Tuple[np.ndarray, ...]]" = OrderedDict()
+        # Region files read so far, and profiles not written yet, by (region, config hash)
+        self._disk: Dict[Tuple[str, str], Dict[ProfileKey, Tuple[np.ndarray, ...]]] = {}
+        self._pending: Dict[Tuple[str, str], Dict[ProfileKey, Tuple[np.ndarray, ...]]] = {}
+        self._pending_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: ProfileKey) -> bool:
+        return key in self._entries
+
+    def get(self, key: ProfileKey) -> Optional[Tuple[np.ndarray, ...]]:
+        """Cached profile for key, or None"""
+        value = self._entries.get(key)
+        if value is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+        if self.store is not None:
+            region = (key.region, key.config_hash)
+            value = self._pending.get(region, {}).get(key)
+            if value is None:
+                if region not in self._disk:
+                    self._disk[region] = self.store.load(*region)
+                value = self._disk[region].get(key)
+            if value is not None:
+                self.disk_hits += 1
+                self._insert(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key: ProfileKey, value: Tuple[np.ndarray, ...]) -> None:
+        """Store a profile, evicting the least recently used ones over budget
+
+        A single profile larger than the whole budget is not kept in memory
+        (it is still written to the store).
+        """
+        if self.store is not None:
+            self._pending.setdefault((key.region, key.config_hash), {})[key] = value
+            self._pending_bytes += _nbytes(value)
+        self._insert(key, value)
+        if self._pending_bytes > self.max_bytes:
+            self.flush()
+
+    def _insert(self, key: ProfileKey, value: Tuple[np.ndarray, ...]) -> None:
+        size = _nbytes(value)
+        if key in self._entries:
+            self.nbytes -= _nbytes(self._entries.pop(key))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = value
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+            self.evictions += 1
+
+    def flush(self) -> None:
+        """Merge the profiles put since the last flush into their region files"""
+        for region, entries in self._pending.items():
+            stored = self._disk.pop(region, None)
+            if stored is None:
+                stored = self.store.load(*region)
+            stored.update(entries)
+            self.store.save(*region, stored)
+        self._pending.clear()
+        self._pending_bytes = 0
+
+    def clear(self) -> None:
+        """Drop every entry (the counters are kept)"""
+        self._entries.clear()
+        self.nbytes = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss/eviction counters and current size"""
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "evictions": self.evictions, "entries": len(self),
+                "bytes": self.nbytes}
+
+    def __str__(self) -> str:
+        lookups = self.hits + self.disk_hits + self.misses
+        rate = 100 * (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        return (f"profile cache: {len(self)} profiles, "
+                f"{self.nbytes / 2**20:.1f}/{self.max_bytes / 2**20:.0f} MB, "
+                f"{self.hits} hits, {self.disk_hits} disk hits, {self.misses} misses "
+                f"({rate:.0f}% hit rate), {self.evictions} evictions")
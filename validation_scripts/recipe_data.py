@@ -0,0 +1,55 @@
+"""
+DATA lines of the observing recipes
+
+A recipe (Recipes/scripts/*.rcp) tunes the Lyot filter with lines of the form
+
+    data  <onband>  <cont>  <wavelength [nm]>  [numsum]    # comment
+
+``read_data_lines`` is the one parser of these lines for passband_metrics,
+tuning_audit, voltage_grid and waveform_bank.  The command is case
+insensitive, onband and cont are returned lower case as taken by
+createStages and VoltageTable, and numsum defaults to 1.  A line whose
+wavelength or numsum is not a number is skipped with a warning (the
+validators report it against the recipe).
+
+Usage:
+    from recipe_data import read_data_lines
+    for line in read_data_lines("Recipes/scripts"):
+        print(line.recipe, line.onband, line.cont, line.wavelength)
+"""
+
+import logging
+from pathlib import Path
+from typing import Iterator, NamedTuple, Union
+
+
+class DataLine(NamedTuple):
+    recipe: str
+    onband: str
+    cont: str
+    wavelength: float
+    numsum: int
+
+
+def read_data_lines(path: Union[Path, str]) -> Iterator[DataLine]:
+    """DATA lines of a recipe, or of every .rcp recipe of a directory
+
+    Args:
+        path: A recipe file, or a directory whose recipes are read in name order
+
+    Yields:
+        The DATA lines of each recipe, in file order
+    """
+    path = Path(path)
+    recipes = sorted(path.glob("*.rcp")) if path.is_dir() else [path]
+    for recipe in recipes:
+        with open(recipe, "r") as f:
+            for line in f:
+                fields = line.split("#")[0].split()
+                if len(fields) < 4 or fields[0].lower() != "data":
+                    continue
+                try:
+                    numsum = int(float(fields[4])) if len(fields) > 4 else 1
+                    yield DataLine(recipe.name, fields[1].lower(), fields[2].lower(), float(fields[3]), numsum)
+                except ValueError:
+                    logging.warning(f"{recipe.name}: unreadable DATA line {line.strip()!r}")
@@ -41,13 +41,20 @@ from enum import Enum
 
 # Try to import mlso_utils, provide fallback if not available
 try:
-    from mlso_utils import getFilterConfig, createStages, find_nearest
+    from mlso_utils import getFilterConfig, createStages, createStagesTemplated, find_nearest, weight_profiles
 except ImportError:
     logging.warning("mlso_utils not found, some features may be limited")
     # Provide stub implementations
     def getFilterConfig(path): return {}
     def createStages(**kwargs): return [], []
+    def createStagesTemplated(**kwargs): return [], []
     def find_nearest(array, value): return 0
+    def weight_profiles(x, profiles, table, method="nearest"): return profiles
+
+try:
+    from kitt_peak_atlas import AtlasStore
+except ImportError:
+    AtlasStore = None
 
 
 # ============================================================================
@@ -532,7 +539,6 @@ class ScriptValidator:
     def _load_tuning_configs(self) -> None:
         """Load tuning configurations if available"""
         try:
-            atlas = self._get_kitt_peak_atlas()
             for tuning_config in glob.glob("../resource/*ini"):
                 key = Path(tuning_config).name.split("_")[-1].split(".")[0]
                 self.tuning_configs[key] = getFilterConfig(tuning_config)
@@ -544,17 +550,6 @@ class ScriptValidator:
         except Exception as e:
             logging.debug(f"Could not load tuning configs: {e}")
     
-    def _get_kitt_peak_atlas(self) -> np.ndarray:
-        """Load Kitt Peak atlas data"""
-        atlas = np.zeros([0, 3])
-        for atlas_name in glob.glob("../resource/lm*"):
-            try:
-                atlas1 = np.loadtxt(atlas_name)
-                atlas = np.concatenate((atlas, atlas1), axis=0)
-            except Exception:
-                pass
-        return atlas
-    
     def validate_menu(self, menu_file: Path) -> List[ValidationIssue]:
         """Validate a menu file and all referenced cookbooks
         
@@ -917,9 +912,11 @@ class ScriptValidator:
 class TuningPlotter:
     """Generates tuning profile plots for recipes"""
     
-    def __init__(self, tuning_configs: Dict, atlas: Optional[np.ndarray] = None):
+    def __init__(self, tuning_configs: Dict, atlas: Optional[np.ndarray] = None,
+                 atlas_store: Optional["AtlasStore"] = None):
         self.tuning_configs = tuning_configs
         self.atlas = atlas
+        self.atlas_store = atlas_store
         self.seen_tunings: Dict = {}
         
     def read_and_plot_rcp(self, recipe_path: Path, output_dir: Path) -> None:
@@ -962,17 +959,33 @@ class TuningPlotter:
             ]
             
             if "prefilter" in self.tuning_configs[tuning_key]:
+                config = self.tuning_configs[tuning_key]
+                
+                # Evaluate every profile not seen yet in one batch
+                missing = [(key, cam) for key in sorted(set(waves))
+                           for cam in ["onband", "offband"]
+                           if f"{key}{cam}" not in self.seen_tunings]
+                if missing:
+                    tuning_wave, batch = createStagesTemplated(
+                        filterConfig=config,
+                        wavelength=[float(key.split()[0]) for key, cam in missing],
+                        cam=[cam for key, cam in missing],
+                        cont=[key.split()[1].lower() for key, cam in missing],
+                        chunk_size=64
+                    )
+                    # One prefilter weighting for the whole batch
+                    tuning_wave, weighted = self._convolve_filters(
+                        None, config, profile=(tuning_wave, batch)
+                    )
+                    for (key, cam), profile in zip(missing, weighted):
+                        self.seen_tunings[f"{key}{cam}"] = (tuning_wave, profile)
+                
                 for key in sorted(set(waves)):
                     wave_val = float(key.split()[0])
                     cont = key.split()[1].lower()
                     
-                    # Calculate convolutions
                     for cam in ["onband", "offband"]:
                         cache_key = f"{key}{cam}"
-                        if cache_key not in self.seen_tunings:
-                            self.seen_tunings[cache_key] = self._convolve_filters(
-                                wave_val, self.tuning_configs[tuning_key], cam, cont
-                            )
                         
                         plt.plot(*self.seen_tunings[cache_key], 
                                 label=f"{wave_val:.2f} {cont} {cam}")
@@ -981,9 +994,25 @@ class TuningPlotter:
                 prefilter = self.tuning_configs[tuning_key]["prefilter"]
                 plt.plot(prefilter[:, 0], prefilter[:, 1], 'k--', alpha=0.5)
             
-            plt.ylabel("Filter throughput [%]")
-            plt.xlabel("Wavelength [nm]")
-            plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+            ax = plt.gca()
+            ax.set_ylabel("Filter throughput [%]")
+            ax.set_xlabel("Wavelength [nm]")
+            handles, labels = ax.get_legend_handles_labels()
+            
+            # Atlas on a background axis, at the decimation level matching the figure width
+            if self.atlas_store is not None:
+                x_lo, x_hi = ax.get_xlim()
+                atlas_ax = ax.twinx()
+                self.atlas_store.plot_envelope(atlas_ax, x_lo, x_hi)
+                atlas_ax.set_xlim(x_lo, x_hi)
+                atlas_ax.set_ylabel("Kitt Peak atlas intensity")
+                atlas_ax.set_zorder(ax.get_zorder() - 1)
+                ax.patch.set_visible(False)
+                atlas_handles, atlas_labels = atlas_ax.get_legend_handles_labels()
+                handles += atlas_handles
+                labels += atlas_labels
+            
+            ax.legend(handles, labels, loc='center left', bbox_to_anchor=(1, 0.5))
             plt.tight_layout()
             
             fig.savefig(output_file, bbox_inches='tight')
@@ -993,8 +1022,10 @@ class TuningPlotter:
             logging.debug(f"Failed to generate plot for {recipe_path}: {e}")
             plt.close('all')
     
-    def _convolve_filters(self, wave: float, config: Dict, 
-                         cam: str = "onband", cont: str = "both") -> Tuple:
+    def _convolve_filters(self, wave: Optional[float], config: Dict,
+                         cam: str = "onband", cont: str = "both",
+                         profile: Optional[Tuple] = None,
+                         method: str = "nearest") -> Tuple:
         """Calculate filter convolution
         
         Args:
@@ -1002,19 +1033,27 @@ class TuningPlotter:
             config: Tuning configuration
             cam: Camera type
             cont: Continuum type
+            profile: Precomputed (wavelengths, transmissions) from
+                     createStagesTemplated, skips createStages.  The
+                     transmissions may be a 2-D stack of profiles on the
+                     shared wavelength grid, all weighted in one call
+            method: Prefilter sampling, "nearest" (the find_nearest lookup,
+                    exact) or "linear" (np.interp)
             
         Returns:
             Tuple of (wavelengths, transmissions)
         """
         try:
-            tuning_wave, tuning_trans = createStages(
-                filterConfig=config, wavelength=wave, cam=cam, cont=cont
-            )
+            if profile is None:
+                tuning_wave, tuning_trans = createStages(
+                    filterConfig=config, wavelength=wave, cam=cam, cont=cont
+                )
+            else:
+                tuning_wave, tuning_trans = profile
             
             if "prefilter" in config:
-                for i in range(len(tuning_wave)):
-                    idx = find_nearest(config["prefilter"][:, 0], tuning_wave[i])
-                    tuning_trans[i] *= config["prefilter"][idx, 1]
+                tuning_trans = weight_profiles(tuning_wave, tuning_trans,
+                                               config["prefilter"], method=method)
             
             return tuning_wave, tuning_trans
         except Exception:
@@ -0,0 +1,293 @@
+"""
+Shared memory store for process pools
+
+When tuning plots or validation run in a process pool, every worker would
+otherwise load the Kitt Peak atlas and the prefilter tables and evaluate the
+same Lyot templates again.  ``SharedArrayStore`` copies named arrays into
+``multiprocessing.shared_memory`` blocks once in the parent; workers attach
+to them by name and get read-only numpy views of the same pages, so their
+private memory does not grow with the size of the inputs.
+
+``publish_tuning_inputs`` shares the region configs (prefilter tables and
+any other array entries), the atlas and the LyotTemplate of every region and
+cam/cont.  ``init_worker`` is the pool initializer that attaches a worker,
+rebuilds the configs around the shared arrays and seeds the mlso_utils
+template cache, after which ``worker_inputs`` returns them.
+
+Usage:
+    from shared_store import publish_tuning_inputs, init_worker, worker_inputs
+    with publish_tuning_inputs(tuning_configs, atlas) as store:
+        with ProcessPoolExecutor(initializer=init_worker,
+                                 initargs=(store.manifest,)) as pool:
+            ...
+    # in a worker task
+    tuning_configs, atlas = worker_inputs()
+
+Run this module to publish the inputs from resource/ and report the memory
+of each worker of a pool of growing size.
+"""
+
+import os
+import sys
+import logging
+import multiprocessing
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+from multiprocessing import shared_memory
+
+from mlso_utils import getFilterConfig, getProfileTemplate
+
+RESOURCE_DIR = Path(__file__).resolve().parent.parent / "resource"
+TEMPLATE_CAMS = ("onband", "offband")
+TEMPLATE_CONTS = ("both", "red", "blue")
+
+
+def _attach_segment(name: str) -> shared_memory.SharedMemory:
+    """Open an existing block without letting this process unlink it
+
+    Before Python 3.13 attaching registers the block with the resource
+    tracker.  Pool workers share the tracker of the parent that owns the
+    block, where the name is already registered, but any other process would
+    get its own tracker, which unlinks the block (warning about a leak) when
+    that process exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    segment = shared_memory.SharedMemory(name=name)
+    if multiprocessing.parent_process() is None:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class SharedArrayStore:
+    """Named numpy arrays in shared memory
+
+    The creating process owns the blocks and unlinks them on ``close``;
+    attached processes only unmap them.  ``manifest`` is a small picklable
+    dict (block names, shapes, dtypes and any extra metadata) that is all a
+    worker needs to attach.
+    """
+
+    def __init__(self, segments: Dict[str, shared_memory.SharedMemory],
+                 manifest: Dict, owner: bool):
+        self._segments = segments
+        self.manifest = manifest
+        self.owner = owner
+        self.arrays: Dict[str, np.ndarray] = {}
+        for name, (block, shape, dtype) in manifest["arrays"].items():
+            view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segments[name].buf)
+            if not owner:
+                view.flags.writeable = False
+            self.arrays[name] = view
+
+    @classmethod
+    def create(cls, arrays: Dict[str, np.ndarray],
+               meta: Optional[Dict] = None) -> "SharedArrayStore":
+        """Copy arrays into new shared memory blocks
+
+        Args:
+            arrays: Arrays to share by name
+            meta: Extra picklable metadata carried in the manifest
+
+        Returns:
+            The owning store
+        """
+        segments = {}
+        manifest = {"arrays": {}, "meta": meta or {}}
+        try:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                segments[name] = segment
+                np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+                manifest["arrays"][name] = (segment.name, array.shape, array.dtype.str)
+        except Exception:
+            for segment in segments.values():
+                segment.close()
+                segment.unlink()
+            raise
+        return cls(segments, manifest, owner=True)
+
+    @classmethod
+    def attach(cls, manifest: Dict) -> "SharedArrayStore":
+        """Attach to the blocks of another process's store, zero copy"""
+        segments = {name: _attach_segment(block)
+                    for name, (block, shape, dtype) in manifest["arrays"].items()}
+        return cls(segments, manifest, owner=False)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.arrays
+
+    def close(self) -> None:
+        """Drop the views and unmap the blocks, unlinking them if owned"""
+        self.arrays = {}
+        for segment in self._segments.values():
+            segment.close()
+            if self.owner:
+                segment.unlink()
+        self._segments = {}
+
+    def __enter__(self) -> "SharedArrayStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _template_name(region: str, cam: str, cont: str) -> str:
+    return f"template/{region}/{cam}/{cont}"
+
+
+def publish_tuning_inputs(tuning_configs: Dict[str, Dict],
+                          atlas: Optional[np.ndarray] = None,
+                          cams: Iterable[str] = TEMPLATE_CAMS,
+                          conts: Iterable[str] = TEMPLATE_CONTS) -> SharedArrayStore:
+    """Share region configs, the atlas and the Lyot templates with workers
+
+    Array entries of each config (the prefilter table, an atlas slice) go to
+    shared memory, scalar and list entries travel in the manifest.  The
+    templates are the default getProfileTemplate ones (no temperature
+    offsets).
+
+    Args:
+        tuning_configs: Region configs by region key, as in the validators
+        atlas: Optional Kitt Peak atlas (e.g. AtlasStore().load())
+        cams, conts: Selections to precompute templates for
+
+    Returns:
+        The owning SharedArrayStore
+    """
+    arrays = {}
+    configs = {}
+    for region, config in tuning_configs.items():
+        configs[region] = {}
+        for name, value in config.items():
+            if isinstance(value, np.ndarray):
+                arrays[f"config/{region}/{name}"] = value
+            else:
+                configs[region][name] = value
+        for cam in cams:
+            for cont in conts:
+                template = getProfileTemplate(config, cam=cam, cont=cont)
+                arrays[_template_name(region, cam, cont)] = template.template
+    if atlas is not None:
+        arrays["atlas"] = atlas
+    return SharedArrayStore.create(arrays, meta={"configs": configs,
+                                                 "cams": list(cams), "conts": list(conts)})
+
+
+def attach_tuning_inputs(manifest: Dict) -> Tuple[SharedArrayStore, Dict[str, Dict], Optional[np.ndarray]]:
+    """Worker side of publish_tuning_inputs
+
+    Returns:
+        (store, tuning_configs, atlas) with the configs' arrays and the atlas
+        as read-only views of the shared blocks.  The mlso_utils template
+        cache is seeded, so createStagesTemplated evaluates no cosines.
+    """
+    store = SharedArrayStore.attach(manifest)
+    meta = manifest["meta"]
+    tuning_configs = {}
+    for region, scalars in meta["configs"].items():
+        config = dict(scalars)
+        prefix = f"config/{region}/"
+        for name, array in store.arrays.items():
+            if name.startswith(prefix):
+                config[name[len(prefix):]] = array
+        tuning_configs[region] = config
+        for cam in meta["cams"]:
+            for cont in meta["conts"]:
+                getProfileTemplate(config, cam=cam, cont=cont,
+                                   template=store[_template_name(region, cam, cont)])
+    atlas = store["atlas"] if "atlas" in store else None
+    return store, tuning_configs, atlas
+
+
+_worker: Dict = {}
+
+
+def init_worker(manifest: Dict) -> None:
+    """Process pool initializer: attach this worker to the shared inputs"""
+    _worker["store"], _worker["configs"], _worker["atlas"] = attach_tuning_inputs(manifest)
+
+
+def worker_inputs() -> Tuple[Dict[str, Dict], Optional[np.ndarray]]:
+    """(tuning_configs, atlas) of a worker started with init_worker"""
+    return _worker["configs"], _worker["atlas"]
+
+
+def _memory_status() -> Dict[str, int]:
+    """Resident memory of this process in kB, split into private and shared
+    memory pages (Linux /proc only, empty elsewhere)"""
+    fields = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "RssAnon", "RssShmem"):
+                    fields[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return fields
+
+
+def _report_task(region: str) -> Tuple[int, Dict[str, int]]:
+    """Touch every shared input of a region, then report this worker's memory"""
+    from mlso_utils import createStagesTemplated, lookup_sorted
+    tuning_configs, atlas = worker_inputs()
+    config = tuning_configs[region]
+    waves = config["region"] + np.linspace(-1, 1, 200)
+    x, profiles = createStagesTemplated(filterConfig=config, wavelength=waves)
+    weight = lookup_sorted(config["prefilter"][:, 0], config["prefilter"][:, 1], x)
+    if atlas is not None:
+        weight = weight * lookup_sorted(atlas[:, 0], atlas[:, 1], x)
+    float(np.sum(profiles @ weight))
+    return os.getpid(), _memory_status()
+
+
+if __name__ == "__main__":
+    import glob
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+    parser = argparse.ArgumentParser(description="Report per worker memory with shared tuning inputs")
+    parser.add_argument("--resource-dir", type=Path, default=RESOURCE_DIR,
+                        help="Directory holding the ini, prefilter and atlas files")
+    parser.add_argument("-j", "--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Pool sizes to try")
+    parser.add_argument("--no-atlas", action="store_true",
+                        help="Do not share the Kitt Peak atlas")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    tuning_configs = {}
+    for ini in glob.glob(str(args.resource_dir / "*ini")):
+        key = Path(ini).name.split("_")[-1].split(".")[0]
+        prefilters = glob.glob(str(args.resource_dir / f"{key}*.csv"))
+        if len(prefilters) == 1:
+            tuning_configs[key] = getFilterConfig(ini)
+            tuning_configs[key]["prefilter"] = np.loadtxt(prefilters[0], delimiter=",", skiprows=10)
+    atlas = None
+    if not args.no_atlas:
+        from kitt_peak_atlas import AtlasStore
+        atlas = np.asarray(AtlasStore(args.resource_dir).load())
+
+    # Spawned workers start empty, so their memory shows what attaching costs
+    context = multiprocessing.get_context("spawn")
+    with publish_tuning_inputs(tuning_configs, atlas) as store:
+        print(f"Shared {len(store.arrays)} arrays, {store.nbytes / 2**20:.1f} MB")
+        for workers in args.workers:
+            with ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker,
+                                     initargs=(store.manifest,)) as pool:
+                reports = dict(pool.map(_report_task, sorted(tuning_configs)))
+            private = [status.get("RssAnon", 0) / 1024 for status in reports.values()]
+            shared = [status.get("RssShmem", 0) / 1024 for status in reports.values()]
+            print(f"{workers} workers: private {np.mean(private):.1f} MB/worker, "
+                  f"shared pages mapped {np.mean(shared):.1f} MB/worker")
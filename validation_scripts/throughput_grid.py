@@ -0,0 +1,366 @@
+"""
+Precomputed throughput lookup grids
+
+The tuning-wavelength explorer and the Lyot primer notebooks recompute Lyot
+profiles for every slider move.  Retuning the filter only translates its
+profile and the profile repeats every FSR, so everything that depends on the
+tuning wavelength is a periodic function of it: one FSR sampled on the
+createStages grid describes every tuning of a region.  ``ThroughputGrid``
+holds, for every cam/cont selection,
+
+  * throughput: sum(weight*profile)/sum(profile), as in tuning_sweep
+  * shift: weighted centroid of the passband minus the tuning wavelength [nm]
+  * rms: weighted rms width of the passband about that centroid [nm]
+
+where the weight is the prefilter (with the Kitt Peak atlas folded in when
+asked for), plus the tuning independent FWHM and peak of the bare Lyot
+profile.  Each array is one FFT correlation at build time; a query is a
+periodic linear interpolation on a uniform grid, a few microseconds for a
+scalar tuning wavelength.
+
+``ThroughputGridStore`` keeps one ``resource/throughput_grid/<region>.npz``
+per region, next to the tuning ini files, stamped with the config_hash of the
+region config (ini values, prefilter and atlas slice) and the grid settings.
+``load`` rebuilds a stale grid by itself; run this module after editing an ini
+or prefilter to rebuild every stale grid up front.
+
+Usage:
+    from throughput_grid import ThroughputGridStore, region_configs
+    configs = region_configs()
+    grid = ThroughputGridStore().load("1074", configs["1074"])
+    grid.throughput(1074.7, "onband", "both")
+    grid.metrics(np.linspace(1074, 1076, 500), "offband", "red")
+    x, profile = grid.profile(1074.81, "onband", "both")
+
+    python throughput_grid.py            # rebuild stale grids
+    python throughput_grid.py --force    # rebuild every grid
+"""
+
+import os
+import glob
+import json
+import math
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+from mlso_utils import (getFilterConfig, getProfileTemplate, lookup_sorted, periodic_grid,
+                        stageProduct, tuningPhases)
+from profile_cache import config_hash
+
+RESOURCE_DIR = Path(__file__).resolve().parent.parent / "resource"
+GRID_DIR_NAME = "throughput_grid"
+# Bump when the grid computation changes, to invalidate every stored grid
+GRID_VERSION = 1
+GRID_CAMS = ("onband", "offband")
+GRID_CONTS = ("both", "red", "blue")
+METRICS = ("throughput", "shift", "rms")
+# Template samples per grid step used for the bare profile FWHM
+FWHM_OVERSAMPLE = 8
+
+
+def region_configs(resource_dir: Union[Path, str] = RESOURCE_DIR,
+                   atlas: bool = False) -> Dict[str, Dict]:
+    """Region configs with their prefilter tables, keyed as in the validators
+
+    Args:
+        resource_dir: Directory holding the tuning ini and prefilter CSV files
+        atlas: Fold the Kitt Peak atlas into each prefilter, like validator.py
+
+    Returns:
+        Dict of region key (e.g. "1074") to getFilterConfig dict with a
+        "prefilter" table
+    """
+    resource_dir = Path(resource_dir)
+    atlas_store = None
+    if atlas:
+        from kitt_peak_atlas import AtlasStore
+        atlas_store = AtlasStore(resource_dir)
+    configs = {}
+    for ini in sorted(glob.glob(str(resource_dir / "*ini"))):
+        key = Path(ini).name.split("_")[-1].split(".")[0]
+        prefilters = glob.glob(str(resource_dir / f"{key}*.csv"))
+        if len(prefilters) != 1:
+            continue
+        config = getFilterConfig(ini)
+        config["prefilter"] = np.loadtxt(prefilters[0], delimiter=",", skiprows=10)
+        if atlas_store is not None:
+            rows = atlas_store.slice(np.min(config["prefilter"][:, 0]), np.max(config["prefilter"][:, 0]))
+            config["prefilter"][:, 1] *= lookup_sorted(rows[:, 0], rows[:, 1], config["prefilter"][:, 0])
+        configs[key] = config
+    return configs
+
+
+def _correlate(weight_fft: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """corr[k] = sum_i weight[i]*kernel[i-k], periodic over the grid"""
+    return np.fft.irfft(weight_fft * np.conj(np.fft.rfft(kernel)), n=kernel.shape[0])
+
+
+def _fwhm(profile: np.ndarray, spacing: float) -> Tuple[float, float, float]:
+    """Full width at half maximum of the highest lobe of one periodic profile
+
+    Returns:
+        (fwhm, peak offset, peak transmission), widths and offsets in the
+        units of spacing, the offset wrapped into [-period/2, period/2)
+    """
+    n = profile.shape[0]
+    peak = int(np.argmax(profile))
+    half = profile[peak] / 2
+    edges = []
+    for direction in (1, -1):
+        index = (peak + direction * np.arange(n)) % n
+        below = np.flatnonzero(profile[index] < half)
+        if below.size == 0:
+            return n * spacing, 0.0, float(profile[peak])
+        j = below[0]
+        inside, outside = profile[index[j - 1]], profile[index[j]]
+        edges.append((j - 1 + (inside - half) / (inside - outside)) * spacing)
+    offset = (peak + n // 2) % n - n // 2
+    return sum(edges), offset * spacing, float(profile[peak])
+
+
+class ThroughputGrid:
+    """Throughput and passband metrics of a region over one FSR of tunings
+
+    Arrays are indexed [selection, tuning] with selections in ``selections``
+    order and tunings ``start + step*i``, i < n.  Tunings outside that FSR
+    wrap around, which is exact: the profile at λ + FSR is the profile at λ.
+    """
+
+    def __init__(self, region: str, config: Dict, start: float, step: float,
+                 selections: Iterable[Tuple[str, str]], metrics: Dict[str, np.ndarray],
+                 passband: np.ndarray, stages: int = 5):
+        """
+        Args:
+            region: Region key (e.g. "1074")
+            config: Scalar entries of the region config (FSR, region, ...)
+            start: First tuning wavelength of the grid [nm]
+            step: Grid spacing [nm]
+            selections: (cam, cont) of each row
+            metrics: METRICS arrays of shape (selections, n)
+            passband: (selections, 3) bare profile FWHM, peak offset and peak
+            stages: Number of Lyot stages
+        """
+        self.region = region
+        self.config = config
+        self.start = float(start)
+        self.step = float(step)
+        self.selections = [tuple(selection) for selection in selections]
+        self._rows = {selection: i for i, selection in enumerate(self.selections)}
+        self.metrics_table = metrics
+        self.passband_table = passband
+        self.stages = stages
+        self.n = metrics["throughput"].shape[1]
+
+    @classmethod
+    def build(cls, region: str, config: Dict, step: Optional[float] = None, stages: int = 5,
+              cams: Iterable[str] = GRID_CAMS, conts: Iterable[str] = GRID_CONTS,
+              method: str = "nearest") -> "ThroughputGrid":
+        """Compute the grid of a region
+
+        Args:
+            region: Region key
+            config: Region config from getFilterConfig, with a "prefilter"
+                    table (a missing prefilter weights every sample by 1)
+            step: Tuning step [nm], defaults to the createStages step FSR/5000
+            stages: Number of Lyot stages
+            cams, conts: Selections to compute, every combination is kept
+            method: Prefilter sampling, see lookup_sorted
+
+        Returns:
+            The ThroughputGrid
+        """
+        FSR = config.get("FSR", 1)
+        if step is None:
+            step = FSR / 5000
+        x = periodic_grid(config, width=1, step=step)
+        n = x.shape[0]
+        weight = np.ones(n)
+        if config.get("prefilter") is not None:
+            prefilter = config["prefilter"]
+            weight = weight * lookup_sorted(prefilter[:, 0], prefilter[:, 1], x, method=method)
+        weight_fft = np.fft.rfft(weight)
+        # Signed distance of each sample from the tuning, wrapped into [-FSR/2, FSR/2)
+        offsets = step * np.arange(n)
+        distance = np.mod(offsets + FSR / 2, FSR) - FSR / 2
+        fine = FSR / (n * FWHM_OVERSAMPLE) * np.arange(n * FWHM_OVERSAMPLE)
+
+        selections = [(cam, cont) for cam in cams for cont in conts]
+        metrics = {name: np.empty((len(selections), n)) for name in METRICS}
+        passband = np.empty((len(selections), 3))
+        for i, (cam, cont) in enumerate(selections):
+            phase = tuningPhases(cam=cam, cont=cont, stages=stages)
+            profile = stageProduct(offsets, FSR, phase, stages)
+            total = _correlate(weight_fft, profile)
+            first = _correlate(weight_fft, distance * profile)
+            second = _correlate(weight_fft, distance**2 * profile)
+            metrics["throughput"][i] = total / np.sum(profile)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                shift = np.where(total > 0, first / total, 0.0)
+                metrics["shift"][i] = shift
+                metrics["rms"][i] = np.sqrt(np.clip(np.where(total > 0, second / total, 0.0) - shift**2, 0, None))
+            passband[i] = _fwhm(stageProduct(fine, FSR, phase, stages), fine[1])
+        scalars = {name: np.asarray(value).tolist() for name, value in config.items()
+                   if not isinstance(value, np.ndarray)}
+        return cls(region, scalars, x[0], step, selections, metrics, passband, stages)
+
+    def _row(self, cam: str, cont: str) -> int:
+        try:
+            return self._rows[(cam.lower(), cont.lower())]
+        except KeyError:
+            raise KeyError(f"No {cam}/{cont} selection in the {self.region} grid") from None
+
+    def _interp(self, values: np.ndarray, wavelength):
+        """Periodic linear interpolation of one row at tuning wavelength(s)"""
+        if isinstance(wavelength, (float, int)):
+            # Plain float arithmetic keeps a single slider query in microseconds
+            position = (wavelength - self.start) / self.step
+            low = math.floor(position)
+            fraction = position - low
+            low %= self.n
+            a = values[low]
+            return float(a + fraction * (values[(low + 1) % self.n] - a))
+        position = (np.asarray(wavelength, dtype=np.float64) - self.start) / self.step
+        low = np.floor(position)
+        fraction = position - low
+        low = low.astype(np.int64) % self.n
+        a = values[low]
+        return a + fraction * (values[(low + 1) % self.n] - a)
+
+    def throughput(self, wavelength, cam: str = "onband", cont: str = "both"):
+        """Prefilter weighted throughput at tuning wavelength(s), in the units of
+        the prefilter (so /100 gives the fraction in the tuning plot legends)"""
+        return self._interp(self.metrics_table["throughput"][self._row(cam, cont)], wavelength)
+
+    def metrics(self, wavelength, cam: str = "onband", cont: str = "both") -> Dict:
+        """Every METRICS entry at tuning wavelength(s)"""
+        row = self._row(cam, cont)
+        return {name: self._interp(table[row], wavelength) for name, table in self.metrics_table.items()}
+
+    def passband(self, cam: str = "onband", cont: str = "both") -> Dict[str, float]:
+        """Tuning independent shape of the bare Lyot profile
+
+        Returns:
+            fwhm [nm] and peak offset from the tuning [nm] of the highest lobe
+            (one of the two continuum lobes for offband), and its peak
+            transmission
+        """
+        fwhm, offset, peak = self.passband_table[self._row(cam, cont)]
+        return {"fwhm": float(fwhm), "peak_offset": float(offset), "peak": float(peak)}
+
+    def profile(self, wavelength=None, cam: str = "onband", cont: str = "both",
+                width: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """Bare Lyot profile on the createStages grid, read out of the cached
+        LyotTemplate (same return as createStages)"""
+        template = getProfileTemplate(self.config, cam=cam, cont=cont, stages=self.stages)
+        return template.profile(wavelength, width=width)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Arrays to save, see ThroughputGridStore"""
+        arrays = {f"metric_{name}": table for name, table in self.metrics_table.items()}
+        arrays.update({"start": np.array(self.start), "step": np.array(self.step),
+                       "stages": np.array(self.stages), "passband": self.passband_table,
+                       "selections": np.array(self.selections),
+                       "config": np.array(json.dumps(self.config))})
+        return arrays
+
+
+def grid_hash(config: Dict, step: Optional[float] = None, stages: int = 5, method: str = "nearest") -> str:
+    """config_hash of the region config together with the grid settings"""
+    return config_hash({**config, "grid_step": np.array(np.nan if step is None else step),
+                        "grid_stages": np.array(stages), "grid_method": np.array(method),
+                        "grid_version": np.array(GRID_VERSION)})
+
+
+class ThroughputGridStore:
+    """On-disk throughput grids, one ``.npz`` per region"""
+
+    def __init__(self, grid_dir: Optional[Union[Path, str]] = None):
+        """
+        Args:
+            grid_dir: Directory of the region grids, defaults to
+                      resource/throughput_grid
+        """
+        self.grid_dir = Path(grid_dir) if grid_dir else RESOURCE_DIR / GRID_DIR_NAME
+
+    def path(self, region: str) -> Path:
+        return self.grid_dir / f"{region}.npz"
+
+    def stored_hash(self, region: str) -> Optional[str]:
+        """Hash the region grid was built with, None if there is no grid"""
+        try:
+            with np.load(self.path(region)) as data:
+                return str(data["grid_hash"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def is_current(self, region: str, config: Dict, **settings) -> bool:
+        return self.stored_hash(region) == grid_hash(config, **settings)
+
+    def read(self, region: str) -> ThroughputGrid:
+        """Load a stored grid without checking it against the config"""
+        with np.load(self.path(region)) as data:
+            config = json.loads(str(data["config"]))
+            metrics = {name: data[f"metric_{name}"] for name in METRICS}
+            return ThroughputGrid(region, config, float(data["start"]), float(data["step"]),
+                                  [tuple(selection) for selection in data["selections"].tolist()],
+                                  metrics, data["passband"], int(data["stages"]))
+
+    def build(self, region: str, config: Dict, **settings) -> ThroughputGrid:
+        """Compute a region grid and write it"""
+        grid = ThroughputGrid.build(region, config, **settings)
+        arrays = grid.arrays()
+        arrays["grid_hash"] = np.array(grid_hash(config, **settings))
+        self.grid_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path(region).with_suffix(".tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.path(region))
+        return grid
+
+    def load(self, region: str, config: Dict, **settings) -> ThroughputGrid:
+        """Stored grid of a region, rebuilt first if missing or stale
+
+        Args:
+            region: Region key
+            config: Current region config (with its "prefilter" table)
+            **settings: step, stages and method, see ThroughputGrid.build
+
+        Returns:
+            The ThroughputGrid
+        """
+        if not self.is_current(region, config, **settings):
+            logging.info(f"Building throughput grid for {region} in {self.grid_dir}")
+            return self.build(region, config, **settings)
+        return self.read(region)
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Rebuild the throughput lookup grids of stale regions")
+    parser.add_argument("regions", nargs="*", help="Region keys to rebuild (default: every region)")
+    parser.add_argument("--resource-dir", type=Path, default=RESOURCE_DIR,
+                        help="Directory holding the ini and prefilter files")
+    parser.add_argument("--grid-dir", type=Path, default=None,
+                        help="Output directory (default: resource/throughput_grid)")
+    parser.add_argument("--atlas", action="store_true",
+                        help="Fold the Kitt Peak atlas into the prefilter weights")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild even if a grid is current")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    store = ThroughputGridStore(args.grid_dir or args.resource_dir / GRID_DIR_NAME)
+    configs = region_configs(args.resource_dir, atlas=args.atlas)
+    for region in args.regions or sorted(configs):
+        if region not in configs:
+            logging.warning(f"No ini and prefilter pair for region {region}")
+            continue
+        if not args.force and store.is_current(region, configs[region]):
+            print(f"{store.path(region)} is current")
+            continue
+        start = time.perf_counter()
+        grid = store.build(region, configs[region])
+        print(f"Wrote {store.path(region)} ({len(grid.selections)} selections x {grid.n} tunings) "
+              f"in {time.perf_counter() - start:.2f} s")
@@ -0,0 +1,205 @@
+"""
+Tuning audit from recorded stage voltages
+
+Recovers what the Lyot filter was actually tuned to from the stage voltages
+and LCVR temperatures recorded with each frame: the voltages are mapped back
+to stage phases through the phase/voltage tables of
+config/tuning_calibration_*.ini and the phases are solved for the tuning
+wavelength, onband camera and continuum (VoltageTable.recover_tuning).  A
+whole day of frames is one call per wave region.
+
+Header values are read from a plain CSV stand-in, one row per frame:
+
+    FILTER      wave region of the frame (e.g. 1074), picks the ini file
+    V_<sensor>  stage voltage [V], one column per stage, named after the
+                stage's temperature sensor without its T_ prefix
+                (V_LCVR1, V_LCVR2, V_LN1, V_LCVR4, V_LCVR5)
+    T_<sensor>  stage temperature [C] (T_LCVR1, ..., as in the ini files)
+    T_COMPS     optional, 0/false when the tuning was not temperature
+                corrected (default: corrected)
+
+Any other columns (a frame name, the expected WAVELNTH/ONBAND/CONTIN) are
+copied to the output next to the recovered values.
+
+Usage:
+    from tuning_audit import load_voltage_tables, read_header_csv, audit_frames
+    tables = load_voltage_tables()
+    frames = read_header_csv("frames.csv")
+    results = audit_frames(tables, frames)
+
+    python tuning_audit.py frames.csv -o audit.csv
+    python tuning_audit.py --simulate frames.csv    # stand-in CSV from the recipe DATA lines
+"""
+
+import csv
+import glob
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Union
+
+from mlso_utils import VoltageTable, tuning_voltages
+from recipe_data import read_data_lines
+
+CONFIG_DIR = Path(__file__).resolve().parent.parent / "config"
+RECIPES_DIR = Path(__file__).resolve().parent.parent / "Recipes"
+OUTPUT_COLUMNS = ("recovered_wavelength", "recovered_onband", "recovered_cont", "residual", "margin")
+
+
+def load_voltage_tables(config_dir: Union[Path, str] = CONFIG_DIR) -> Dict[str, VoltageTable]:
+    """Phase/voltage tables of every tuning_calibration ini file
+
+    Returns:
+        Dict of region key (the integer part of the reference wavelength, as
+        in the FILTER column) to VoltageTable
+    """
+    tables = {}
+    for ini in sorted(glob.glob(str(Path(config_dir) / "tuning_calibration_*.ini"))):
+        table = VoltageTable(Path(ini).resolve())
+        tables[str(int(table.reference_wavelength))] = table
+    return tables
+
+
+def _column_names(table: VoltageTable) -> List[str]:
+    return [sensor[2:] if sensor.upper().startswith("T_") else sensor for sensor in table.sensor]
+
+
+def voltage_columns(table: VoltageTable) -> List[str]:
+    return [f"V_{name}" for name in _column_names(table)]
+
+
+def temperature_columns(table: VoltageTable) -> List[str]:
+    return [f"T_{name}" for name in _column_names(table)]
+
+
+def read_header_csv(path: Union[Path, str]) -> List[Dict[str, str]]:
+    """Rows of a header stand-in CSV as dicts of column name to text"""
+    with open(path, "r", newline="") as f:
+        return [{key.strip(): value.strip() for key, value in row.items() if key is not None}
+                for row in csv.DictReader(f)]
+
+
+def _enabled(value: str) -> bool:
+    return value.strip().lower() not in ("0", "false", "no", "off")
+
+
+def audit_frames(tables: Dict[str, VoltageTable], frames: List[Dict[str, str]]) -> List[Dict[str, object]]:
+    """Recover the tuning of every frame
+
+    Frames are grouped by FILTER and by whether they were temperature
+    corrected, and each group is solved in one vectorized call.
+
+    Args:
+        tables: Output of load_voltage_tables
+        frames: Rows of read_header_csv
+
+    Returns:
+        The frames with the OUTPUT_COLUMNS added, in input order.  Frames of an
+        unknown FILTER are returned unchanged (with a warning).
+    """
+    results = [dict(frame) for frame in frames]
+    groups: Dict[tuple, List[int]] = {}
+    for i, frame in enumerate(frames):
+        corrected = _enabled(frame.get("T_COMPS", "1"))
+        groups.setdefault((frame.get("FILTER", "").split(".")[0], corrected), []).append(i)
+    for (region, corrected), rows in groups.items():
+        if region not in tables:
+            logging.warning(f"No tuning calibration for FILTER {region!r}, {len(rows)} frames skipped")
+            continue
+        table = tables[region]
+        voltages = np.array([[float(frames[i][name]) for name in voltage_columns(table)] for i in rows])
+        temps = None
+        if corrected:
+            temps = np.array([[float(frames[i][name]) for name in temperature_columns(table)] for i in rows])
+        recovered = table.recover_tuning(voltages, lcvrTemps=temps)
+        for j, i in enumerate(rows):
+            results[i].update({"recovered_wavelength": float(recovered["wavelength"][j]),
+                               "recovered_onband": str(recovered["onband"][j]),
+                               "recovered_cont": str(recovered["cont"][j]),
+                               "residual": float(recovered["residual"][j]),
+                               "margin": float(recovered["margin"][j])})
+    return results
+
+
+def write_audit_csv(results: List[Dict[str, object]], path: Union[Path, str]) -> None:
+    columns = []
+    for row in results:
+        columns.extend(name for name in row if name not in columns)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in results:
+            writer.writerow([f"{row[name]:.6g}" if isinstance(row.get(name), float) else row.get(name, "")
+                             for name in columns])
+
+
+def simulate_header_csv(tables: Dict[str, VoltageTable], path: Union[Path, str],
+                        scripts_dir: Union[Path, str] = RECIPES_DIR / "scripts",
+                        temperature_sigma: float = 0.5, seed: int = 0) -> int:
+    """Write a stand-in CSV with one frame per recipe DATA line
+
+    Voltages come from the forward engine at temperatures scattered around
+    each stage's reference temperature, the expected tuning is kept in the
+    WAVELNTH, ONBAND and CONTIN columns.
+
+    Returns:
+        Number of frames written
+    """
+    rng = np.random.default_rng(seed)
+    frames = list(read_data_lines(scripts_dir))
+    regions = list(tables)
+    order = [tables[region] for region in regions]
+    wavelength = np.array([frame.wavelength for frame in frames])
+    reference = np.array([table.reference_wavelength for table in order])
+    nearest = np.argmin(np.abs(wavelength[:, None] - reference[None, :]), axis=1)
+    temps = np.array([order[i].reference_temp for i in nearest])
+    temps = temps + rng.normal(0, temperature_sigma, temps.shape)
+    voltages, region = tuning_voltages(order, wavelength, [frame.onband for frame in frames],
+                                       [frame.cont for frame in frames], lcvrTemps=temps)
+    with open(path, "w", newline="") as f:
+        writer = None
+        for i, frame in enumerate(frames):
+            table = order[region[i]]
+            row = {"FRAME": f"{i:05d}", "RECIPE": frame.recipe, "FILTER": regions[region[i]], "T_COMPS": 1}
+            row.update({name: f"{value:.7f}" for name, value in zip(voltage_columns(table), voltages[i])})
+            row.update({name: f"{value:.3f}" for name, value in zip(temperature_columns(table), temps[i])})
+            row.update({"WAVELNTH": frame.wavelength, "ONBAND": frame.onband, "CONTIN": frame.cont})
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+    return len(frames)
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Recover Lyot tunings from recorded stage voltages")
+    parser.add_argument("frames", type=Path, help="Header stand-in CSV, one row per frame")
+    parser.add_argument("-o", "--output", type=Path, default=None,
+                        help="Write the frames with the recovered tuning to this CSV")
+    parser.add_argument("--config-dir", type=Path, default=CONFIG_DIR,
+                        help="Directory holding the tuning_calibration ini files")
+    parser.add_argument("--simulate", action="store_true",
+                        help="Write a stand-in CSV from the recipe DATA lines to FRAMES instead")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    tables = load_voltage_tables(args.config_dir)
+    if args.simulate:
+        print(f"Wrote {simulate_header_csv(tables, args.frames)} frames to {args.frames}")
+    else:
+        frames = read_header_csv(args.frames)
+        start = time.perf_counter()
+        results = audit_frames(tables, frames)
+        print(f"Recovered {len(results)} frames in {(time.perf_counter() - start) * 1000:.1f} ms")
+        expected = [row for row in results if "WAVELNTH" in row and "recovered_wavelength" in row]
+        if expected:
+            error = np.array([row["recovered_wavelength"] - float(row["WAVELNTH"]) for row in expected])
+            mismatched = sum(row["recovered_onband"] != row.get("ONBAND", "").lower()
+                             or row["recovered_cont"] != row.get("CONTIN", "").lower() for row in expected)
+            print(f"Against WAVELNTH: max |error| {np.max(np.abs(error)):.2e} nm, "
+                  f"{mismatched} onband/continuum mismatches")
+        if args.output:
+            write_audit_csv(results, args.output)
+            print(f"Wrote {args.output}")
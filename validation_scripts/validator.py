@@ -18,6 +18,9 @@
 import os
 import numpy as np
 from mlso_utils import *
+from kitt_peak_atlas import AtlasStore, LineCatalog
+from profile_cache import ProfileCache, ProfileKey, ProfileStore, config_hash
+from passband_metrics import metrics_table, recipe_tunings, write_metrics_table
 from pathlib import Path
 import glob
 
@@ -28,41 +31,68 @@ import glob
 import numpy as np
 import matplotlib.pylab as plt
 
-def get_kitt_peak_atlas():
-    atlas = np.zeros([0,3])
-    print(glob.glob("../resource/lm*"))
-    for atlas_name in glob.glob("../resource/lm*"):
-        print(atlas_name)
-        atlas1 = np.loadtxt(atlas_name)
-        atlas = np.concatenate((atlas,atlas1),axis=0)
-    return atlas
-
-atlas = get_kitt_peak_atlas()
+# Only the atlas chunks under each prefilter passband are parsed, see AtlasStore.slice
+atlas_store = AtlasStore("../resource")
+# Draw the atlas envelope on a second axis behind the tuning plots
+plot_atlas_envelope = False
 
 tuning_configs = {}
-seen_tunings={}
+# Profiles shared between recipes, LRU bounded in memory and kept between runs in resource/profile_cache
+# (see profile_cache.py)
+profile_cache = ProfileCache(store=ProfileStore("../resource/profile_cache"))
+# Atlas rows under every prefilter, the absorption line catalog is built from these
+atlas_slices = []
 
 for tuning_config in glob.glob("../resource/*ini"):
     key = Path(tuning_config).name.split("_")[-1].split(".")[0]
     tuning_configs[key] =  getFilterConfig(tuning_config)
     if len(glob.glob(f"../resource/{key}*.csv")) == 1:
         tuning_configs[key]["prefilter"] = np.loadtxt(glob.glob(f"../resource/{key}*.csv")[0],delimiter=",",skiprows =10)
-        for tune_number in range(len(tuning_configs[key]["prefilter"][:,0])):
-            atlas_value =    atlas[find_nearest(atlas[:,0],tuning_configs[key]["prefilter"][tune_number,0]),1]
-            tuning_configs[key]["prefilter"][tune_number,1] = atlas_value*tuning_configs[key]["prefilter"][tune_number,1]
+        atlas = atlas_store.slice(np.min(tuning_configs[key]["prefilter"][:,0]),np.max(tuning_configs[key]["prefilter"][:,0]))
+        atlas_slices.append(atlas)
+        atlas_values = lookup_sorted(atlas[:,0],atlas[:,1],tuning_configs[key]["prefilter"][:,0],method="nearest")
+        tuning_configs[key]["prefilter"][:,1] = atlas_values*tuning_configs[key]["prefilter"][:,1]
         #tuning_configs[key]["prefilter"] = np.array([tuning_configs[key]["prefilter"][:,0],tune_values])
         #print(tuning_configs[key]["prefilter"].shape)
+tuning_hashes = {key:config_hash(config) for key,config in tuning_configs.items()}
         
 
-def convolve_filters(wave,config,cam="onband",cont="both"):
-    tuning_wave,tuning_trans = createStages(filterConfig=config,wavelength=wave,cam=cam,cont=cont)
-    for i in range(len(tuning_wave)):
-        tuning_trans[i] = tuning_trans[i]*config["prefilter"][find_nearest(config
-                                                                           ["prefilter"][:,0],tuning_wave[i]),1]
-    return tuning_wave,tuning_trans
+def convolve_filters(wave,config,cam="onband",cont="both",profile=None,method="nearest"):
+    # profile: precomputed (tuning_wave,tuning_trans) from createStagesTemplated, tuning_trans can be a 2d stack
+    # method: prefilter sampling, "nearest" matches the per sample find_nearest lookup (see weight_profiles)
+    if profile is None:
+        tuning_wave,tuning_trans = createStages(filterConfig=config,wavelength=wave,cam=cam,cont=cont)
+    else:
+        tuning_wave,tuning_trans = profile
+    return tuning_wave,weight_profiles(tuning_wave,tuning_trans,config["prefilter"],method=method)
 
 print(tuning_configs.keys())
 
+# Absorption lines deep enough to spoil a tuning, checked for every coronal DATA wavelength
+# and its continuum (offband) positions.  The catalog only covers the prefilter passbands,
+# so the full atlas is never opened.
+deep_line_depth = 0.05
+line_catalog = LineCatalog.from_atlas(np.concatenate(atlas_slices))
+# (recipe, tuning) pairs already reported, and the hits of every tuning checked so far
+flagged_tunings = set()
+tuning_line_hits = {}
+
+def absorption_lines_hit(wave,cont):
+    wave_keys = np.array(list(tuning_configs.keys()),dtype=np.uint16)
+    config = tuning_configs[list(tuning_configs.keys())[find_nearest(wave_keys,wave)]]
+    half_width = 0.886*config["FSR"]/2**5/2   # half the FWHM of the 5 stage passband
+    positions = {"onband":[wave]}
+    # The offband camera looks FSR/4 to either side, RED/BLUE keep only one side
+    positions["continuum"] = {"both":[wave-config["FSR"]/4,wave+config["FSR"]/4],
+                              "red":[wave+config["FSR"]/4],
+                              "blue":[wave-config["FSR"]/4]}[cont]
+    hits = []
+    for label in positions:
+        for position in positions[label]:
+            for i in line_catalog.near(position,half_width,min_depth=deep_line_depth):
+                hits.append(f"{label} {position:.2f} overlaps absorption line {line_catalog.wave[i]:.3f} nm (depth {line_catalog.depth[i]:.2f})")
+    return hits
+
 def read_and_plot_rcp(recipe_path):
 
     with open(recipe_path,"r") as recipe:
@@ -81,23 +111,57 @@ def read_and_plot_rcp(recipe_path):
         wave_keys = np.array(list(tuning_configs.keys()),dtype=np.uint16)
         tuning_key  = list(tuning_configs.keys())[find_nearest(wave_keys,mvalue)]
         if "prefilter" in tuning_configs[tuning_key]:
-            tuning_wave,onband_trans = createStages(filterConfig=tuning_configs[tuning_key],cam="onband",cont=(waves[0].split()[1]).lower())
-            tuning_wave,offband_trans = createStages(filterConfig=tuning_configs[tuning_key],cam="offband",cont=(waves[0].split()[1]).lower())
+            # Weighted and normalization profiles come from profile_cache; the misses are evaluated in one batch,
+            # read out of one cached Lyot template per cam/cont (see LyotTemplate)
+            region_hash = tuning_hashes[tuning_key]
+            def profile_key(key,cam):
+                return ProfileKey.make(tuning_key,np.float32(key.split()[0]),cam,key.split()[1],region_hash)
+            norm_cont = (waves[0].split()[1]).lower()
+            norm_keys = [ProfileKey.make(tuning_key,tuning_configs[tuning_key]["region"],cam,norm_cont,region_hash,kind="lyot") for cam in ["onband","offband"]]
+            norms = [profile_cache.get(norm_key) for norm_key in norm_keys]
+            profiles = {}
+            missing = []
+            for key in sorted(set(waves)):
+                for cam in ["onband","offband"]:
+                    profiles[key+cam] = profile_cache.get(profile_key(key,cam))
+                    if profiles[key+cam] is None:
+                        missing.append((key,cam))
+            missing_norms = [i for i,norm in enumerate(norms) if norm is None]
+            if missing or missing_norms:
+                batch_waves = [tuning_configs[tuning_key]["region"] for i in missing_norms] + [np.float32(key.split()[0]) for key,cam in missing]
+                batch_cams = [["onband","offband"][i] for i in missing_norms] + [cam for key,cam in missing]
+                batch_conts = [norm_cont for i in missing_norms] + [(key.split()[1]).lower() for key,cam in missing]
+                tuning_wave,batch = createStagesTemplated(filterConfig=tuning_configs[tuning_key],wavelength=batch_waves,cam=batch_cams,cont=batch_conts,chunk_size=64)
+                for i,profile in zip(missing_norms,batch):
+                    norms[i] = (tuning_wave,profile)
+                    profile_cache.put(norm_keys[i],norms[i])
+                # Every missing profile is weighted by the prefilter in one call
+                tuning_wave,weighted = convolve_filters(None,tuning_configs[tuning_key],profile=(tuning_wave,batch[len(missing_norms):]))
+                for (key,cam),profile in zip(missing,weighted):
+                    profiles[key+cam] = (tuning_wave,profile)
+                    profile_cache.put(profile_key(key,cam),profiles[key+cam])
+            onband_trans,offband_trans = norms[0][1],norms[1][1]
 
             for key in list(set(sorted(waves))):
-               
-                if key+"onband" not in  seen_tunings:
-                    seen_tunings[key+"onband" ] = convolve_filters(np.float32(key.split()[0]),config=tuning_configs[tuning_key],cam="onband",cont=(key.split()[1]).lower())
-                if key+"offband" not in  seen_tunings:  
-                    seen_tunings[key+"offband" ] = convolve_filters(np.float32(key.split()[0]),config=tuning_configs[tuning_key],cam="offband",cont=(key.split()[1]).lower())
                 
-                plt.plot(*seen_tunings[key+"onband"  ],label=f"{np.float32(key.split()[0]):.2f} {key.split()[1]} {np.sum(seen_tunings[key+'onband'][1])/(np.sum(onband_trans)*100):.2f} onband")
-                plt.plot(*seen_tunings[key+"offband" ],label=f"{np.float32(key.split()[0]):.2f} {key.split()[1]} {np.sum(seen_tunings[key+'offband'][1])/(np.sum(offband_trans)*100):.2f} offband")
+                plt.plot(*profiles[key+"onband"  ],label=f"{np.float32(key.split()[0]):.2f} {key.split()[1]} {np.sum(profiles[key+'onband'][1])/(np.sum(onband_trans)*100):.2f} onband")
+                plt.plot(*profiles[key+"offband" ],label=f"{np.float32(key.split()[0]):.2f} {key.split()[1]} {np.sum(profiles[key+'offband'][1])/(np.sum(offband_trans)*100):.2f} offband")
                 plt.plot(tuning_configs[tuning_key]["prefilter"][:,0],tuning_configs[tuning_key]["prefilter"][:,1])
                 if len(waves) < 3:
-                    percent_onband = np.sum(seen_tunings[key+'onband'][1])/(np.sum(onband_trans)*100)
-                    percent_offband = np.sum(seen_tunings[key+'offband'][1])/(np.sum(offband_trans)*100)
+                    percent_onband = np.sum(profiles[key+'onband'][1])/(np.sum(onband_trans)*100)
+                    percent_offband = np.sum(profiles[key+'offband'][1])/(np.sum(offband_trans)*100)
                 #    print(f"{key}  {percent_onband:.2f},  {percent_offband:.2f} {percent_onband-percent_offband:.2f} {percent_onband/percent_offband:.2f}")
+            if plot_atlas_envelope:
+                # Kitt Peak atlas behind the profiles, decimated to the pixel width of the figure
+                ax = plt.gca()
+                x_lo,x_hi = ax.get_xlim()
+                atlas_ax = ax.twinx()
+                atlas_store.plot_envelope(atlas_ax,x_lo,x_hi)
+                atlas_ax.set_xlim(x_lo,x_hi)
+                atlas_ax.set_ylabel("Kitt Peak atlas intensity")
+                atlas_ax.set_zorder(ax.get_zorder()-1)
+                ax.patch.set_visible(False)
+                plt.sca(ax)
             legend = fig.legend(loc='center left', bbox_to_anchor=(1, 0.5))
             plt.ylabel("Filter throughput [%]")
             plt.xlabel("wavelength [nm]")
@@ -355,6 +419,12 @@ def  read_script(script_name_in,parent,tab,state,darks,flat,coronal,coronalExp,s
                         flat_recipes.append(script_name.name)
                     if state['shut'] == "out" and state['calib'] =='out' and state['diffuser'] == "out":
                         emoji = icons["data"]
+                        if (parent,cont+wave) not in flagged_tunings:
+                            flagged_tunings.add((parent,cont+wave))
+                            if cont+wave not in tuning_line_hits:
+                                tuning_line_hits[cont+wave] = absorption_lines_hit(float(wave),cont)
+                            for hit in tuning_line_hits[cont+wave]:
+                                warning.write(f"{parent} {{ {tab_space.join(commands)} }} {hit}\n")
                         coronal.append(state['gain']+cam+cont+wave)
                         coronalExp.append(state['exposure']+state['gain'])
                         data_recipes.append(script_name.name)
@@ -420,3 +490,7 @@ for menu in menus:
     md.close()
     summary.close()
 warning.close()
+# Throughput, peak, FWHM, centroid offset and leakage behind the tuning plots, one row per recipe tuning
+write_metrics_table(metrics_table(tuning_configs,recipe_tunings("scripts")),"passband_metrics.csv")
+profile_cache.flush()
+print(profile_cache)
@@ -0,0 +1,374 @@
+"""
+Temperature-indexed stage voltages of every recipe tuning
+
+The real-time tuning turns a recipe wavelength into stage voltages by the
+phase arithmetic of config/Lyot-phase-to-voltage.md and a spline of each
+stage's phase table (VoltageTable.stage_voltages), redone for every frame
+because the temperature correction moves the phase.  For a fixed tuning a
+stage's voltage only depends on that stage's temperature, so it is tabulated
+here once per (wavelength, onband, cont) used in Recipes/scripts on a uniform
+grid of temperature offsets around each stage's reference_temp; a frame then
+needs one 1-D interpolation per stage, a cubic Hermite one from the stored
+voltages and their exact temperature derivatives.
+
+The temperature correction wraps the phase by pi whenever it leaves the
+phase table, which makes the voltage jump (every pi/|temp_coefficient|, about
+0.3 C for the 530 nm stages).  The exact temperature of every jump is stored
+with the grid, and a query in a cell holding a jump continues the cubic of
+the neighbouring cell on its own side instead of interpolating across it.
+
+``VoltageGridStore`` keeps one ``resource/voltage_grid/<region>.npz`` per
+region (voltages and derivatives as float32, jumps as a sparse list), stamped with a hash of
+the ini calibration values and the grid settings.  ``update`` regenerates
+incrementally: a region whose ini changed is rebuilt, otherwise only tunings
+that are new to the recipes are computed and tunings no recipe uses any more
+are dropped; an unchanged region is not rewritten.
+
+Usage:
+    from voltage_grid import VoltageGridStore
+    grids = VoltageGridStore().update()
+    grids["1074"].voltages(1074.7, "tcam", "both", lcvrTemps=[34.6, 34.4, 34.6, 34.5, 34.4])
+
+    python voltage_grid.py               # update resource/voltage_grid
+    python voltage_grid.py --force       # rebuild every region
+    python voltage_grid.py --check 2000  # compare random frames with stage_voltages
+"""
+
+import os
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from mlso_utils import VoltageTable
+from profile_cache import config_hash
+from passband_metrics import WAVELENGTH_DECIMALS
+from recipe_data import read_data_lines
+from tuning_audit import load_voltage_tables
+
+CONFIG_DIR = Path(__file__).resolve().parent.parent / "config"
+RECIPES_DIR = Path(__file__).resolve().parent.parent / "Recipes"
+RESOURCE_DIR = Path(__file__).resolve().parent.parent / "resource"
+GRID_DIR_NAME = "voltage_grid"
+# Bump when the grid computation changes, to invalidate every stored grid
+GRID_VERSION = 1
+# Temperature offsets from each stage's reference_temp covered by the grid [C]
+TEMPERATURE_SPAN = 2.0
+# Grid spacing [C]; keeps the lookup within 0.2 mV of stage_voltages where the voltage is steepest (top of the
+# phase tables, largest temp_coefficient)
+TEMPERATURE_STEP = 0.005
+# Bisection steps locating a phase wrap inside a grid cell
+JUMP_BISECTIONS = 30
+
+Tuning = Tuple[float, str, str]
+
+
+def recipe_tunings(scripts_dir: Union[Path, str] = RECIPES_DIR / "scripts") -> Dict[Tuning, Set[str]]:
+    """DATA tunings of every .rcp recipe
+
+    Returns:
+        Dict of (wavelength, onband, cont) to the names of the recipes using
+        it, onband and cont lower case as taken by VoltageTable
+    """
+    tunings: Dict[Tuning, Set[str]] = {}
+    for line in read_data_lines(scripts_dir):
+        tunings.setdefault((round(line.wavelength, WAVELENGTH_DECIMALS), line.onband, line.cont),
+                           set()).add(line.recipe)
+    return tunings
+
+
+def table_hash(table: VoltageTable, span: float = TEMPERATURE_SPAN, step: float = TEMPERATURE_STEP) -> str:
+    """config_hash of the calibration values of an ini file and the grid settings"""
+    return config_hash({"reference_wavelength": np.array(table.reference_wavelength),
+                        "wavelength_offset": np.array(table.wavelength_offset),
+                        "voltages": table.voltages, "period": table.period,
+                        "temp_coefficient": table.temp_coefficient, "reference_temp": table.reference_temp,
+                        "phases": table.phases, "grid_span": np.array(span), "grid_step": np.array(step),
+                        "grid_version": np.array(GRID_VERSION)})
+
+
+class VoltageGrid:
+    """Stage voltages of a set of tunings of one region against temperature"""
+
+    def __init__(self, region: str, reference_temp: np.ndarray, start: float, step: float,
+                 tunings: List[Tuning], voltages: np.ndarray, slopes: np.ndarray, jumps: np.ndarray):
+        """
+        Args:
+            region: Region key
+            reference_temp: reference_temp of every stage [C]
+            start, step: First temperature offset from reference_temp and grid spacing [C]
+            tunings: (wavelength, onband, cont) of every row
+            voltages: Stage voltages [V], shape (tunings, stages, temperatures)
+            slopes: Their temperature derivatives [V/C], same shape
+            jumps: Temperature offset of the phase wrap inside each grid cell,
+                   NaN for cells without one, shape (tunings, stages, temperatures-1)
+        """
+        self.region = region
+        self.reference_temp = np.asarray(reference_temp, dtype=np.float64)
+        self.start = float(start)
+        self.step = float(step)
+        self.tunings = [(float(w), str(o), str(c)) for w, o, c in tunings]
+        self.voltages_table = voltages
+        self.slopes = slopes
+        self.jumps = jumps
+        self._rows = {tuning: i for i, tuning in enumerate(self.tunings)}
+
+    @property
+    def stages(self) -> int:
+        return self.voltages_table.shape[1]
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return self.start + self.step * np.arange(self.voltages_table.shape[2])
+
+    @classmethod
+    def build(cls, region: str, table: VoltageTable, tunings: Iterable[Tuning],
+              span: float = TEMPERATURE_SPAN, step: float = TEMPERATURE_STEP) -> "VoltageGrid":
+        """Tabulate tunings from the phase arithmetic and splines of a VoltageTable
+
+        Args:
+            region: Region key
+            table: Calibration of the region
+            tunings: (wavelength, onband, cont) to tabulate
+            span: Temperatures from reference_temp - span to reference_temp + span [C]
+            step: Grid spacing [C]
+        """
+        tunings = list(tunings)
+        count = int(round(2 * span / step)) + 1
+        offsets = -span + step * np.arange(count)
+        n, stages = len(tunings), table.stages
+        if n == 0:
+            empty = np.empty((0, stages, count), dtype=np.float32)
+            return cls(region, table.reference_temp, -span, step, tunings, empty, empty,
+                       np.empty((0, stages, count - 1)))
+        wavelength, onband, cont = (np.repeat(np.array(values), count) for values in zip(*tunings))
+        temps = table.reference_temp[None, :] + np.tile(offsets, n)[:, None]
+        phase = table.stage_phases(wavelength.astype(np.float64), onband=onband, cont=cont, lcvrTemps=temps)
+        voltages = np.stack([spline(phase[:, s]) for s, spline in enumerate(table.splines)], axis=1)
+        voltages = voltages.reshape(n, count, stages).transpose(0, 2, 1).astype(np.float32)
+        slope = -table.temp_coefficient
+        slopes = np.stack([spline.derivative(phase[:, s]) * slope[s] for s, spline in enumerate(table.splines)],
+                          axis=1)
+        slopes = slopes.reshape(n, count, stages).transpose(0, 2, 1).astype(np.float32)
+
+        # A wrap moves the phase by about pi against the steady -temp_coefficient drift.  Which table edge sets it
+        # off depends on the unwrapped phase, so the jump is located by bisecting the forward rule within the cell
+        phase = phase.reshape(n, count, stages).transpose(0, 2, 1)
+        rows, columns, cells = np.nonzero(np.abs(np.diff(phase, axis=2)) > np.pi / 2)
+        low, high = offsets[cells], offsets[cells + 1]
+        start_phase = phase[rows, columns, cells]
+        for _ in range(JUMP_BISECTIONS):
+            middle = (low + high) / 2
+            first = rows * count
+            moved = table.stage_phases(wavelength[first], onband=onband[first], cont=cont[first],
+                                       lcvrTemps=table.reference_temp[None, :] + middle[:, None])
+            moved = moved[np.arange(rows.shape[0]), columns]
+            same = np.abs(moved - start_phase - slope[columns] * (middle - offsets[cells])) < np.pi / 2
+            low, high = np.where(same, middle, low), np.where(same, high, middle)
+        jumps = np.full((n, stages, count - 1), np.nan)
+        jumps[rows, columns, cells] = (low + high) / 2
+        return cls(region, table.reference_temp, -span, step, tunings, voltages, slopes, jumps)
+
+    def rows(self, tunings: Iterable[Tuning]) -> np.ndarray:
+        """Row index of every tuning (KeyError for a tuning not in the grid)"""
+        return np.array([self._rows[tuning] for tuning in tunings], dtype=np.int64)
+
+    def subset(self, tunings: Iterable[Tuning]) -> "VoltageGrid":
+        tunings = list(tunings)
+        rows = self.rows(tunings)
+        return VoltageGrid(self.region, self.reference_temp, self.start, self.step, tunings,
+                           self.voltages_table[rows], self.slopes[rows], self.jumps[rows])
+
+    def extend(self, other: "VoltageGrid") -> "VoltageGrid":
+        """Grid with the rows of another grid of the same settings appended"""
+        return VoltageGrid(self.region, self.reference_temp, self.start, self.step, self.tunings + other.tunings,
+                           np.concatenate([self.voltages_table, other.voltages_table]),
+                           np.concatenate([self.slopes, other.slopes]),
+                           np.concatenate([self.jumps, other.jumps]))
+
+    def voltages(self, wavelength, onband="tcam", cont="both", lcvrTemps=None) -> np.ndarray:
+        """Temperature corrected stage voltages of many frames
+
+        Args:
+            wavelength: Tuning wavelengths [nm], one per frame; rounded like
+                        the recipe DATA lines before the lookup
+            onband, cont: One value or one per frame, as VoltageTable.stage_phases
+            lcvrTemps: Stage temperatures [C], (stages,) or (frames, stages);
+                       None gives the voltages at reference_temp
+
+        Returns:
+            Voltages [V], shape (frames, stages), NaN where a temperature is
+            outside the grid.  Raises KeyError for a tuning not in the grid.
+        """
+        wavelength = np.round(np.atleast_1d(np.asarray(wavelength, dtype=np.float64)), WAVELENGTH_DECIMALS)
+        n = wavelength.shape[0]
+        onband = np.char.lower(np.broadcast_to(np.asarray(onband, dtype=str), (n,)))
+        cont = np.char.lower(np.broadcast_to(np.asarray(cont, dtype=str), (n,)))
+        row = self.rows(zip(wavelength.tolist(), onband.tolist(), cont.tolist()))[:, None]
+        temps = self.reference_temp if lcvrTemps is None else lcvrTemps
+        offset = np.broadcast_to(np.asarray(temps, dtype=np.float64), (n, self.stages)) - self.reference_temp
+        stage = np.arange(self.stages)[None, :]
+
+        count = self.voltages_table.shape[2]
+        position = (offset - self.start) / self.step
+        cell = np.clip(np.floor(position).astype(np.int64), 0, count - 2)
+        fraction = position - cell
+
+        # Across a wrap, continue the cubic of the neighbouring cell on the query's side of the jump; a jump in an
+        # end cell has no neighbour there and continues the end sample's tangent instead
+        jump = self.jumps[row, stage, cell]
+        side = np.where(jump > offset, -1, np.where(jump <= offset, 1, 0))
+        edge = (cell + side < 0) | (cell + side > count - 2)
+        cell = np.where(edge, cell, cell + side)
+        t = np.where(edge, np.where(side > 0, fraction - 1, fraction), fraction - side)
+
+        voltage, slope = self.voltages_table, self.slopes
+        p0 = voltage[row, stage, cell].astype(np.float64)
+        p1 = voltage[row, stage, cell + 1].astype(np.float64)
+        m0 = slope[row, stage, cell].astype(np.float64) * self.step
+        m1 = slope[row, stage, cell + 1].astype(np.float64) * self.step
+        result = p0 + t * (m0 + t * (3 * (p1 - p0) - 2 * m0 - m1 + t * (2 * (p0 - p1) + m0 + m1)))
+        result = np.where(edge & (side < 0), p0 + t * m0, np.where(edge & (side > 0), p1 + t * m1, result))
+        return np.where((position >= 0) & (position <= count - 1), result, np.nan)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Arrays to save, see VoltageGridStore"""
+        wavelength, onband, cont = zip(*self.tunings) if self.tunings else ((), (), ())
+        index = np.flatnonzero(~np.isnan(self.jumps))
+        return {"wavelength": np.array(wavelength, dtype=np.float64), "onband": np.array(onband, dtype=str),
+                "cont": np.array(cont, dtype=str), "reference_temp": self.reference_temp,
+                "start": np.array(self.start), "step": np.array(self.step), "voltages": self.voltages_table,
+                "slopes": self.slopes,
+                "jump_index": index, "jump_offset": self.jumps.ravel()[index].astype(np.float32)}
+
+
+class VoltageGridStore:
+    """On-disk voltage grids, one ``.npz`` per region"""
+
+    def __init__(self, grid_dir: Optional[Union[Path, str]] = None):
+        """
+        Args:
+            grid_dir: Directory of the region grids, defaults to
+                      resource/voltage_grid
+        """
+        self.grid_dir = Path(grid_dir) if grid_dir else RESOURCE_DIR / GRID_DIR_NAME
+
+    def path(self, region: str) -> Path:
+        return self.grid_dir / f"{region}.npz"
+
+    def stored_hash(self, region: str) -> Optional[str]:
+        """Hash the region grid was built with, None if there is no grid"""
+        try:
+            with np.load(self.path(region)) as data:
+                return str(data["grid_hash"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def read(self, region: str) -> VoltageGrid:
+        """Load a stored grid without checking it against the ini"""
+        with np.load(self.path(region)) as data:
+            voltages = data["voltages"]
+            jumps = np.full((voltages.shape[0], voltages.shape[1], voltages.shape[2] - 1), np.nan)
+            jumps.ravel()[data["jump_index"]] = data["jump_offset"]
+            tunings = list(zip(data["wavelength"].tolist(), data["onband"].tolist(), data["cont"].tolist()))
+            return VoltageGrid(region, data["reference_temp"], float(data["start"]), float(data["step"]),
+                               tunings, voltages, data["slopes"], jumps)
+
+    def write(self, grid: VoltageGrid, grid_hash: str) -> None:
+        arrays = grid.arrays()
+        arrays["grid_hash"] = np.array(grid_hash)
+        self.grid_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path(grid.region).with_suffix(".tmp.npz")
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.path(grid.region))
+
+    def update_region(self, region: str, table: VoltageTable, tunings: Iterable[Tuning], force: bool = False,
+                      span: float = TEMPERATURE_SPAN, step: float = TEMPERATURE_STEP) -> VoltageGrid:
+        """Stored grid of a region holding exactly the given tunings
+
+        Rebuilds the grid when the ini calibration or the grid settings
+        changed (or force), otherwise computes only the missing tunings and
+        drops unused ones; an unchanged grid is not rewritten.
+        """
+        tunings = sorted(set(tunings))
+        current = table_hash(table, span=span, step=step)
+        if force or self.stored_hash(region) != current:
+            logging.info(f"Building voltage grid for {region} ({len(tunings)} tunings) in {self.grid_dir}")
+            grid = VoltageGrid.build(region, table, tunings, span=span, step=step)
+            self.write(grid, current)
+            return grid
+        grid = self.read(region)
+        stored = set(grid.tunings)
+        missing = [tuning for tuning in tunings if tuning not in stored]
+        if not missing and len(stored) == len(tunings):
+            return grid
+        logging.info(f"Updating voltage grid for {region}: {len(missing)} new, "
+                     f"{len(stored) - len(tunings) + len(missing)} dropped tunings")
+        grid = grid.subset([tuning for tuning in tunings if tuning in stored])
+        grid = grid.extend(VoltageGrid.build(region, table, missing, span=span, step=step))
+        self.write(grid, current)
+        return grid
+
+    def update(self, config_dir: Union[Path, str] = CONFIG_DIR,
+               scripts_dir: Union[Path, str] = RECIPES_DIR / "scripts", force: bool = False,
+               **settings) -> Dict[str, VoltageGrid]:
+        """Bring the grid of every region in line with the ini files and recipes
+
+        Args:
+            config_dir: Directory of the tuning_calibration ini files
+            scripts_dir: Directory of the recipe files
+            force: Rebuild every region
+            **settings: span and step, see VoltageGrid.build
+
+        Returns:
+            Dict of region key to VoltageGrid
+        """
+        tables = load_voltage_tables(config_dir)
+        regions = list(tables)
+        references = np.array([tables[region].reference_wavelength for region in regions])
+        by_region: Dict[str, List[Tuning]] = {region: [] for region in regions}
+        for tuning in recipe_tunings(scripts_dir):
+            by_region[regions[int(np.argmin(np.abs(references - tuning[0])))]].append(tuning)
+        return {region: self.update_region(region, tables[region], by_region[region], force=force, **settings)
+                for region in regions}
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Update the temperature-indexed voltage grids of the recipe tunings")
+    parser.add_argument("--config-dir", type=Path, default=CONFIG_DIR,
+                        help="Directory holding the tuning_calibration ini files")
+    parser.add_argument("--recipes-dir", type=Path, default=RECIPES_DIR,
+                        help="Recipes directory (recipes are read from its scripts folder)")
+    parser.add_argument("--grid-dir", type=Path, default=None,
+                        help="Output directory (default: resource/voltage_grid)")
+    parser.add_argument("--span", type=float, default=TEMPERATURE_SPAN,
+                        help="Temperature offsets covered either side of reference_temp [C]")
+    parser.add_argument("--step", type=float, default=TEMPERATURE_STEP, help="Grid spacing [C]")
+    parser.add_argument("--force", action="store_true", help="Rebuild every region")
+    parser.add_argument("--check", type=int, default=0, metavar="N",
+                        help="Compare N random frames per region with VoltageTable.stage_voltages")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    start = time.perf_counter()
+    grids = VoltageGridStore(args.grid_dir).update(args.config_dir, args.recipes_dir / "scripts", force=args.force,
+                                                   span=args.span, step=args.step)
+    print(f"{sum(len(grid.tunings) for grid in grids.values())} tunings in {len(grids)} regions, "
+          f"{time.perf_counter() - start:.2f} s")
+    if args.check:
+        rng = np.random.default_rng(0)
+        tables = load_voltage_tables(args.config_dir)
+        for region, grid in grids.items():
+            if not grid.tunings:
+                continue
+            picks = [grid.tunings[i] for i in rng.integers(len(grid.tunings), size=args.check)]
+            wavelength, onband, cont = (np.array(values) for values in zip(*picks))
+            temps = grid.reference_temp + rng.uniform(-args.span, args.span, (args.check, grid.stages))
+            start = time.perf_counter()
+            looked_up = grid.voltages(wavelength, onband, cont, lcvrTemps=temps)
+            elapsed = time.perf_counter() - start
+            exact = tables[region].stage_voltages(wavelength, onband=onband, cont=cont, lcvrTemps=temps)
+            print(f"{region:>5}: max |error| {np.max(np.abs(looked_up - exact)) * 1000:.4f} mV, "
+                  f"{elapsed / args.check * 1e6:.2f} us per frame")
@@ -0,0 +1,241 @@
+"""
+Analog-output waveform banks of recipes
+
+Builds the waveforms the DAQ drives for every DATA line of a recipe into one
+preallocated (n_lines, n_channels, numS) array, so a recipe or the whole
+library can be preflighted and two calibrations diffed offline.  The channel
+layout, sample rate and buffer length come from config/instrument_config.ini:
+
+    [sampling info]        fs (sample rate [Hz]) and numS (samples per line)
+    [DAQ Physical Channels] lyotAO is the task (Dev1/ao0:7); felcAO and
+                           triggerAO name channels inside it, the remaining
+                           channels drive the Lyot stages in Stage0..Stage4 order
+    [FeLC Voltages]        vneg and vpos, the FeLC drive levels
+
+Each Lyot stage channel carries a DC free square wave of +/- the stage
+voltage from the phase-to-voltage mapping (VoltageTable.stage_voltages) at the
+LCVR carrier frequency.  The FeLC switching and the camera trigger follow the
+acquisition timing, which neither the recipe nor the ini files define: the
+FeLC channels get a quadrature vneg/vpos square wave only when a modulation
+frequency is given and otherwise stay at 0 V, like the trigger channel.
+
+Stage voltages are solved once per distinct (wavelength, onband, cont) of
+the recipe and every line of a tuning reuses them.  With an output path the
+bank is an .npy memory map filled a chunk of lines at a time, so a large
+recipe never needs the whole array in memory.
+
+Usage:
+    from tuning_audit import load_voltage_tables
+    from waveform_bank import InstrumentConfig, recipe_lines, waveform_bank
+    instrument = InstrumentConfig.read()
+    lines = recipe_lines("Recipes/scripts/1074_01wave_2beam_16sums_2rep_BOTH.rcp")
+    bank = waveform_bank(lines, load_voltage_tables(), instrument)
+
+    python waveform_bank.py -o /tmp/bank                     # every recipe, one .npy each
+    python waveform_bank.py 1074_01wave_2beam_16sums_2rep_BOTH.rcp --diff /tmp/bank
+"""
+
+import re
+import logging
+import configparser
+import numpy as np
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from mlso_utils import VoltageTable, tuning_voltages
+from recipe_data import DataLine, read_data_lines
+from tuning_audit import load_voltage_tables
+
+CONFIG_DIR = Path(__file__).resolve().parent.parent / "config"
+RECIPES_DIR = Path(__file__).resolve().parent.parent / "Recipes"
+INSTRUMENT_CONFIG = CONFIG_DIR / "instrument_config.ini"
+# Square wave drive frequency of the LCVRs [Hz]
+LCVR_CARRIER = 2000.0
+# Output range of the analog outputs [V]
+AO_LIMIT = 10.0
+# Lines filled at a time when writing a memory map
+CHUNK_LINES = 16
+
+
+def _channels(spec: str) -> Tuple[str, List[int]]:
+    """Device and channel numbers of a DAQmx physical channel, e.g. Dev1/ao0:7"""
+    match = re.fullmatch(r"\s*(\S+)/ao(\d+)(?::(\d+))?\s*", spec)
+    if not match:
+        raise ValueError(f"Not an analog output channel range: {spec!r}")
+    first = int(match.group(2))
+    last = int(match.group(3)) if match.group(3) is not None else first
+    return match.group(1), list(range(first, last + 1))
+
+
+@dataclass
+class InstrumentConfig:
+    """Waveform settings of instrument_config.ini"""
+    fs: float
+    samples: int
+    vneg: float
+    vpos: float
+    device: str
+    channels: List[int]
+    felc_channels: List[int]
+    trigger_channels: List[int]
+
+    @classmethod
+    def read(cls, path: Union[Path, str] = INSTRUMENT_CONFIG) -> "InstrumentConfig":
+        ini = configparser.ConfigParser(interpolation=None, strict=False)
+        if not ini.read(path):
+            raise FileNotFoundError(f"Instrument config not found: {path}")
+        device, channels = _channels(ini["DAQ Physical Channels"]["lyotAO"])
+        felc = _channels(ini["DAQ Physical Channels"]["felcAO"])[1]
+        trigger = _channels(ini["DAQ Physical Channels"]["triggerAO"])[1]
+        return cls(fs=float(ini["sampling info"]["fs"]), samples=int(ini["sampling info"]["numS"]),
+                   vneg=float(ini["FeLC Voltages"]["vneg"]), vpos=float(ini["FeLC Voltages"]["vpos"]),
+                   device=device, channels=channels, felc_channels=felc, trigger_channels=trigger)
+
+    @property
+    def stage_channels(self) -> List[int]:
+        """Channels driving the Lyot stages, in stage order"""
+        return [c for c in self.channels if c not in self.felc_channels and c not in self.trigger_channels]
+
+    def index(self, channels: List[int]) -> List[int]:
+        """Positions of channels along the channel axis of a bank"""
+        return [self.channels.index(c) for c in channels]
+
+
+def recipe_lines(path: Union[Path, str]) -> List[DataLine]:
+    """DATA lines of a recipe, in order (onband and cont lower case)"""
+    return list(read_data_lines(path))
+
+
+def square_wave(instrument: InstrumentConfig, frequency: float, phase: float = 0.0) -> np.ndarray:
+    """+/-1 square wave of numS samples at fs, phase in cycles"""
+    t = np.arange(instrument.samples) / instrument.fs
+    return np.where(np.mod(frequency * t + phase, 1.0) < 0.5, 1.0, -1.0)
+
+
+def waveform_bank(lines: List[DataLine], tables: Dict[str, VoltageTable], instrument: InstrumentConfig,
+                  lcvrTemps=None, carrier: float = LCVR_CARRIER, felc_frequency: Optional[float] = None,
+                  output: Optional[Union[Path, str]] = None, dtype=np.float64,
+                  chunk_lines: int = CHUNK_LINES) -> np.ndarray:
+    """Waveforms of every DATA line of a recipe
+
+    Args:
+        lines: Output of recipe_lines
+        tables: VoltageTables by region key, see load_voltage_tables
+        instrument: Channel layout and sampling, see InstrumentConfig
+        lcvrTemps: Stage temperatures [C] for the temperature correction,
+                   (stages,) or one row per line; None tunes without it
+        carrier: LCVR square wave frequency [Hz]
+        felc_frequency: FeLC modulation frequency [Hz]; None leaves the FeLC
+                        channels at 0 V
+        output: Write the bank to this .npy file as a memory map
+        dtype: Sample type of the bank
+        chunk_lines: Lines filled at a time
+
+    Returns:
+        The bank, shape (n_lines, n_channels, numS), a np.memmap when output
+        is given
+    """
+    shape = (len(lines), len(instrument.channels), instrument.samples)
+    if output is not None:
+        bank = np.lib.format.open_memmap(output, mode="w+", dtype=dtype, shape=shape)
+    else:
+        bank = np.empty(shape, dtype=dtype)
+    if not lines:
+        return bank
+
+    # One voltage solve per distinct tuning, shared by every line using it
+    tunings = [(line.wavelength, line.onband, line.cont) for line in lines]
+    distinct = sorted(set(tunings))
+    lookup = {tuning: i for i, tuning in enumerate(distinct)}
+    use = np.array([lookup[tuning] for tuning in tunings])
+    order = list(tables.values())
+    temps = None
+    if lcvrTemps is not None:
+        temps = np.asarray(lcvrTemps, dtype=np.float64)
+        if temps.ndim == 2:
+            # Per line temperatures make every line its own tuning
+            distinct = tunings
+            use = np.arange(len(lines))
+    wavelength, onband, cont = (np.array(values) for values in zip(*distinct))
+    voltages, _ = tuning_voltages(order, wavelength, onband, cont, lcvrTemps=temps)
+
+    stages = instrument.index(instrument.stage_channels)
+    if voltages.shape[1] != len(stages):
+        raise ValueError(f"{voltages.shape[1]} Lyot stages but {len(stages)} stage channels in {instrument.device}")
+    over = np.abs(voltages) > AO_LIMIT
+    if np.any(over):
+        logging.warning(f"{int(np.sum(np.any(over[use], axis=1)))} lines exceed the +/-{AO_LIMIT} V output range")
+
+    carrier_wave = square_wave(instrument, carrier).astype(dtype)
+    fixed = np.zeros((len(instrument.channels), instrument.samples), dtype=dtype)
+    if felc_frequency is not None:
+        middle, amplitude = (instrument.vpos + instrument.vneg) / 2, (instrument.vpos - instrument.vneg) / 2
+        for k, channel in enumerate(instrument.index(instrument.felc_channels)):
+            fixed[channel] = middle + amplitude * square_wave(instrument, felc_frequency, phase=-k / 4)
+
+    for first in range(0, len(lines), chunk_lines):
+        chunk = slice(first, min(first + chunk_lines, len(lines)))
+        bank[chunk] = fixed
+        bank[chunk, stages, :] = voltages[use[chunk]].astype(dtype)[:, :, None] * carrier_wave[None, None, :]
+    if output is not None:
+        bank.flush()
+    return bank
+
+
+def diff_banks(bank: np.ndarray, other: np.ndarray) -> np.ndarray:
+    """Largest absolute difference of every line and channel, shape (n_lines, n_channels)"""
+    if bank.shape != other.shape:
+        raise ValueError(f"Banks differ in shape: {bank.shape} and {other.shape}")
+    return np.stack([np.max(np.abs(np.asarray(bank[i], dtype=np.float64) - other[i]), axis=-1)
+                     for i in range(bank.shape[0])]) if bank.shape[0] else np.empty(bank.shape[:2])
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the analog-output waveform banks of recipes")
+    parser.add_argument("recipes", nargs="*", help="Recipe file names (default: every recipe with DATA lines)")
+    parser.add_argument("--recipes-dir", type=Path, default=RECIPES_DIR,
+                        help="Recipes directory (recipes are read from its scripts folder)")
+    parser.add_argument("--config-dir", type=Path, default=CONFIG_DIR,
+                        help="Directory holding instrument_config.ini and the tuning_calibration ini files")
+    parser.add_argument("-o", "--output-dir", type=Path, default=None,
+                        help="Write each bank as <recipe>.npy to this directory")
+    parser.add_argument("--diff", type=Path, default=None,
+                        help="Compare with the banks previously written to this directory")
+    parser.add_argument("--carrier", type=float, default=LCVR_CARRIER, help="LCVR square wave frequency [Hz]")
+    parser.add_argument("--felc-frequency", type=float, default=None, help="FeLC modulation frequency [Hz]")
+    parser.add_argument("--float32", action="store_true", help="Store the samples as float32")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+    instrument = InstrumentConfig.read(args.config_dir / "instrument_config.ini")
+    tables = load_voltage_tables(args.config_dir)
+    scripts = args.recipes_dir / "scripts"
+    paths = [scripts / name for name in args.recipes] if args.recipes else sorted(scripts.glob("*.rcp"))
+    if args.output_dir:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    total = built = 0
+    for path in paths:
+        lines = recipe_lines(path)
+        if not lines:
+            continue
+        output = args.output_dir / f"{path.stem}.npy" if args.output_dir else None
+        bank = waveform_bank(lines, tables, instrument, carrier=args.carrier, felc_frequency=args.felc_frequency,
+                             output=output, dtype=np.float32 if args.float32 else np.float64)
+        total += len(lines)
+        built += 1
+        if args.diff:
+            previous = args.diff / f"{path.stem}.npy"
+            if not previous.exists():
+                print(f"{path.name}: no bank in {args.diff}")
+                continue
+            difference = diff_banks(bank, np.load(previous, mmap_mode="r"))
+            line, channel = np.unravel_index(np.argmax(difference), difference.shape)
+            print(f"{path.name}: max |difference| {difference[line, channel] * 1000:.3f} mV "
+                  f"(line {line}, ao{instrument.channels[channel]})")
+    print(f"{total} lines of {built} recipes in {time.perf_counter() - start:.2f} s, "
+          f"{instrument.samples} samples at {instrument.fs:g} Hz on {instrument.device}/ao"
+          f"{instrument.channels[0]}:{instrument.channels[-1]}")